@@ -0,0 +1,84 @@
+import functools
+
+import db
+
+# Множество главных админов
+MAIN_ADMINS = {6897531034, 6176677671, 1552916570, 1040487188, 1380600483, 7176188474, 651856676}
+
+# Уровни доступа к админским действиям
+CLASS_ADMIN, FULL_ADMIN, MAIN_ADMIN = range(3)
+
+# user_id -> None (все классы) или frozenset доступных классов.
+# Строится из admins.class_access при старте и обновляется при сохранении админа
+_acl = {}
+
+
+def parse_class_access(value: str):
+    if not value or value.strip().lower() == "all":
+        return None
+    return frozenset(cls.strip() for cls in value.split(",") if cls.strip())
+
+
+def load(rows):
+    global _acl
+    _acl = {user_id: parse_class_access(class_access) for user_id, class_access in rows}
+
+
+async def refresh():
+    load(await db.get_admins())
+
+
+def grant(user_id: int, class_access: str):
+    _acl[user_id] = parse_class_access(class_access)
+
+
+def is_admin(user_id: int) -> bool:
+    return user_id in MAIN_ADMINS or user_id in _acl
+
+
+def has_full_access(user_id: int) -> bool:
+    return user_id in MAIN_ADMINS or (user_id in _acl and _acl[user_id] is None)
+
+
+def can_access_class(user_id: int, class_name: str) -> bool:
+    if user_id in MAIN_ADMINS:
+        return True
+    if user_id not in _acl:
+        return False
+    allowed = _acl[user_id]
+    return allowed is None or class_name in allowed
+
+
+# Список классов, видимых админу, в исходном порядке
+def filter_classes(user_id: int, classes: list) -> list:
+    if has_full_access(user_id):
+        return classes
+    return [cls for cls in classes if can_access_class(user_id, cls)]
+
+
+def _has_level(user_id: int, level: int) -> bool:
+    if level == MAIN_ADMIN:
+        return user_id in MAIN_ADMINS
+    if level == FULL_ADMIN:
+        return has_full_access(user_id)
+    return is_admin(user_id)
+
+
+async def deny(update, text: str = "🚫 У вас нет доступа."):
+    if update.callback_query:
+        await update.callback_query.answer(text, show_alert=True)
+    elif update.effective_message:
+        await update.effective_message.reply_text(text)
+
+
+# Проверка уровня доступа перед обработчиком; без доступа обработчик не вызывается
+def admin_required(level: int = CLASS_ADMIN):
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if not _has_level(update.effective_user.id, level):
+                await deny(update)
+                return None
+            return await handler(update, context)
+        return wrapper
+    return decorator
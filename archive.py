@@ -0,0 +1,261 @@
+import os
+import re
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import zipfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import packs
+
+# Лимит Telegram на отправку документа ботом и запас на служебные данные ZIP
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+MAX_PART_SIZE = TELEGRAM_DOCUMENT_LIMIT - 1024 * 1024
+
+# Уже сжатые форматы кладём в архив без DEFLATE
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip'}
+
+# Заголовки записи (локальный, центральный каталог, дескриптор) без имени файла
+ENTRY_OVERHEAD = 30 + 46 + 16
+END_RECORD_SIZE = 22
+
+
+def _entry_size(arcname: str, path: str, where: tuple) -> int:
+    return packs.size(path, where) + ENTRY_OVERHEAD + 2 * len(arcname.encode())
+
+
+def compress_type(path: str) -> int:
+    if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def part_filename(name: str, index: int, total: int) -> str:
+    if total == 1:
+        return f"{name}.zip"
+    return f"{name}.part{index}of{total}.zip"
+
+
+# Отпечаток набора файлов архива: записи (id, имя в архиве, путь, место в паке).
+# Место в паке не учитывается: упаковка файла не меняет его содержимое
+def manifest_digest(entries: list) -> str:
+    digest = hashlib.sha256()
+    for entry_id, arcname, path, _ in entries:
+        digest.update(f"{entry_id}\0{arcname}\0{path}\n".encode())
+    return digest.hexdigest()
+
+
+def _remove(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _entry_key(entry_id, arcname: str, path: str, where: tuple = None) -> str:
+    return f"{entry_id}:{arcname}:{path}"
+
+
+# Кеш собранных архивов. Для каждого набора (ученик, класс, вся школа)
+# хранятся части на диске и манифест с составом каждой части. Новые
+# скриншоты дописываются в последнюю часть, пока она укладывается в лимит;
+# удаление или изменение уже упакованных строк ведёт к полной пересборке.
+# Части не меняются на месте: дописанная часть копируется под новым именем,
+# поэтому уже выданный путь всегда указывает на целый архив, а прежние версии
+# удаляет вытеснение, когда они перестают быть нужны.
+# Одинаковые одновременные запросы ждут одну общую сборку, а между
+# процессами бота набор защищён блокировкой файла .lock.
+class ArchiveCache:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._locks = {}
+        self._inflight = {}
+
+    def _base(self, scope: str) -> str:
+        safe = re.sub(r'[^\w-]', '_', scope)[:40]
+        return os.path.join(self.root, f"{safe}_{hashlib.sha1(scope.encode()).hexdigest()[:8]}")
+
+    def _load(self, scope: str) -> dict:
+        try:
+            with open(self._base(scope) + ".json", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"digest": None, "parts": []}
+
+    def _save(self, scope: str, manifest: dict):
+        path = self._base(scope) + ".json"
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+    # Новое имя для каждой версии части; основа имени общая, по ней набор вытесняется целиком
+    def _part_path(self, scope: str, index: int) -> str:
+        return f"{self._base(scope)}.part{index}.{time.time_ns():x}.zip"
+
+    def _drop_manifest(self, scope: str):
+        try:
+            os.remove(self._base(scope) + ".json")
+        except FileNotFoundError:
+            pass
+
+    # Части архива для набора entries = [(id, имя в архиве, путь, место в паке или None)]
+    async def get(self, scope: str, entries: list, on_progress=None) -> list:
+        key = (scope, manifest_digest(entries))
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._build_locked(scope, entries, key[1], on_progress))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def _lock(self, scope: str) -> asyncio.Lock:
+        return self._locks.setdefault(scope, asyncio.Lock())
+
+    # Блокировка набора между процессами; без fcntl (не POSIX) бот работает одним процессом
+    @contextlib.contextmanager
+    def _file_lock(self, scope: str):
+        if fcntl is None:
+            yield
+            return
+        with open(self._base(scope) + ".lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _build_exclusive(self, scope: str, entries: list, digest: str, on_progress) -> list:
+        with self._file_lock(scope):
+            return self._build(scope, entries, digest, on_progress)
+
+    async def _build_locked(self, scope: str, entries: list, digest: str, on_progress) -> list:
+        async with self._lock(scope):
+            return await asyncio.to_thread(self._build_exclusive, scope, entries, digest, on_progress)
+
+    def _build(self, scope: str, entries: list, digest: str, on_progress) -> list:
+        manifest = self._load(scope)
+        if manifest["digest"] == digest and all(os.path.exists(p["path"]) for p in manifest["parts"]):
+            # время изменения манифеста — время последнего использования для вытеснения
+            os.utime(self._base(scope) + ".json")
+            return manifest["parts"]
+        current = {_entry_key(*entry) for entry in entries}
+        packed = {key for part in manifest["parts"] for key in part["entries"]}
+        if not packed <= current or not all(os.path.exists(p["path"]) for p in manifest["parts"]):
+            manifest, packed = {"digest": None, "parts": []}, set()
+        new_entries = [entry for entry in entries if _entry_key(*entry) not in packed]
+        # Пока части меняются, манифеста нет: после сбоя набор соберётся заново
+        self._drop_manifest(scope)
+        parts = manifest["parts"]
+        # части, уже записанные в этой сборке: их можно дописывать без копирования
+        fresh = set()
+        zf = None
+        try:
+            for done, (entry_id, arcname, path, where) in enumerate(new_entries, start=1):
+                try:
+                    size = _entry_size(arcname, path, where)
+                except OSError:
+                    continue
+                if not parts or parts[-1]["size"] + size > MAX_PART_SIZE:
+                    if zf:
+                        zf.close()
+                        zf = None
+                    parts.append({"path": self._part_path(scope, len(parts) + 1),
+                                  "size": END_RECORD_SIZE, "entries": [], "file_id": None, "sent_as": None})
+                    fresh.add(parts[-1]["path"])
+                part = parts[-1]
+                if part["path"] not in fresh:
+                    copy = self._part_path(scope, len(parts))
+                    shutil.copyfile(part["path"], copy)
+                    part["path"] = copy
+                    fresh.add(copy)
+                if zf is None:
+                    zf = zipfile.ZipFile(part["path"], 'a')
+                if where:
+                    info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+                    info.compress_type = compress_type(path)
+                    zf.writestr(info, packs.read(path, where) or b"")
+                else:
+                    zf.write(path, arcname, compress_type=compress_type(path))
+                part["size"] += size
+                part["entries"].append(_entry_key(entry_id, arcname, path))
+                part["file_id"] = part["sent_as"] = None
+                if on_progress:
+                    on_progress(done, len(new_entries))
+        finally:
+            if zf:
+                zf.close()
+        manifest["digest"] = digest
+        self._save(scope, manifest)
+        return parts
+
+    # Прежние версии частей: их нет в манифесте набора. Без манифеста (набор
+    # пересобирается) ничего не считается прежним
+    @staticmethod
+    def _superseded(base: str, paths: list) -> set:
+        try:
+            with open(base + ".json", encoding="utf-8") as f:
+                current = {part["path"] for part in json.load(f)["parts"]}
+        except (OSError, ValueError):
+            return set()
+        return {path for path in paths if path.endswith(".zip") and path not in current}
+
+    # Вытеснение из кеша: сначала прежние версии частей, затем наборы, не
+    # использованные дольше max_age секунд, затем самые давние, пока кеш больше
+    # max_bytes. Файлы, тронутые за последние grace секунд, не удаляются: их
+    # могут отправлять прямо сейчас. Возвращает освобождённый объём в байтах
+    def evict(self, max_age: float, max_bytes: int, grace: float = 600) -> int:
+        groups = {}
+        for name in os.listdir(self.root):
+            # файлы блокировок крошечные и могут быть заняты другим процессом
+            if name.endswith(".lock"):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            groups.setdefault(name.split(".", 1)[0], {})[path] = stat
+        now = time.time()
+        freed = 0
+        sets = []
+        for base, files in groups.items():
+            for path in self._superseded(os.path.join(self.root, base), list(files)):
+                if now - files[path].st_mtime > grace and _remove(path):
+                    freed += files.pop(path).st_size
+            if files:
+                sets.append({"paths": list(files), "size": sum(stat.st_size for stat in files.values()),
+                             "used": max(stat.st_mtime for stat in files.values())})
+        total = sum(group["size"] for group in sets)
+        for group in sorted(sets, key=lambda group: group["used"]):
+            if now - group["used"] < grace:
+                break
+            if now - group["used"] < max_age and total <= max_bytes:
+                break
+            for path in group["paths"]:
+                _remove(path)
+            total -= group["size"]
+            freed += group["size"]
+        return freed
+
+    # Запоминаем file_id отправленной части, чтобы повторно слать её без загрузки.
+    # Отправленная часть задаётся путём и числом записей на момент чтения: если
+    # за время загрузки её дописали, file_id не подходит к новой версии и не сохраняется
+    async def remember_file_id(self, scope: str, sent_part: dict, file_id: str, sent_as: str):
+        async with self._lock(scope):
+            await asyncio.to_thread(self._set_file_id, scope, sent_part, file_id, sent_as)
+
+    def _set_file_id(self, scope: str, sent_part: dict, file_id: str, sent_as: str):
+        with self._file_lock(scope):
+            manifest = self._load(scope)
+            if not manifest["digest"]:
+                return
+            for part in manifest["parts"]:
+                if part["path"] == sent_part["path"] and len(part["entries"]) == len(sent_part["entries"]):
+                    part["file_id"], part["sent_as"] = file_id, sent_as
+            self._save(scope, manifest)
@@ -0,0 +1,162 @@
+import json
+import time
+import asyncio
+import email.parser
+from urllib.parse import parse_qs
+
+# Локальная замена Bot API для нагрузочных тестов. Понимает вызовы, которые
+# делает бот, отдаёт ему обновления через getUpdates и пересылает каждый ответ
+# бота в очередь чата, где его ждёт симулированный пользователь
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+
+class FakeBotAPI:
+    def __init__(self):
+        self.updates = []
+        self.update_id = 0
+        self.message_id = 0
+        self.file_id = 0
+        self.files = {}
+        self.calls = {}
+        self.chat_queues = {}
+        self.first_poll = asyncio.Event()
+        self._new_updates = asyncio.Event()
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    # Обновления и файлы со стороны симулированных пользователей
+    def push_update(self, update: dict):
+        self.update_id += 1
+        update["update_id"] = self.update_id
+        self.updates.append(update)
+        self._new_updates.set()
+
+    def add_file(self, data: bytes) -> dict:
+        self.file_id += 1
+        file_id = f"bench_file_{self.file_id}"
+        self.files[file_id] = data
+        return {"file_id": file_id, "file_unique_id": f"u{self.file_id}", "width": 1280, "height": 720,
+                "file_size": len(data)}
+
+    def chat_queue(self, chat_id: int) -> asyncio.Queue:
+        queue = self.chat_queues.get(chat_id)
+        if queue is None:
+            queue = self.chat_queues[chat_id] = asyncio.Queue()
+        return queue
+
+    # HTTP/1.1 с keep-alive: PTB держит пул соединений
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+                status, content_type, payload = await self._dispatch(path, headers, body)
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, path: str, headers: dict, body: bytes):
+        if path.startswith("/file/bot"):
+            file_id = path.rsplit("/", 1)[-1].split(".")[0]
+            data = self.files.get(file_id)
+            if data is None:
+                return "404 Not Found", "text/plain", b"not found"
+            return "200 OK", "application/octet-stream", data
+        method = path.rsplit("/", 1)[-1]
+        params = _parse_params(headers.get("content-type", ""), body)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        result = await self._call(method, params)
+        return "200 OK", "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+    def _message(self, chat_id, **fields) -> dict:
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()),
+                   "chat": {"id": int(chat_id), "type": "private"}, "from": BOT_USER}
+        message.update(fields)
+        return message
+
+    def _photo_sizes(self) -> list:
+        self.file_id += 1
+        return [{"file_id": f"sent_{self.file_id}", "file_unique_id": f"s{self.file_id}", "width": 1280, "height": 720}]
+
+    async def _call(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return await self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files.get(file_id, b"")),
+                    "file_path": f"photos/{file_id}.jpg"}
+        chat_id = params.get("chat_id")
+        if method == "answerCallbackQuery":
+            # id запроса начинается с чата, откуда он пришёл: всплывающие ответы тоже видны пользователю
+            chat_id = params["callback_query_id"].split("_", 1)[0] if params.get("text") else None
+        if chat_id is None:
+            return True
+        if method == "sendPhoto":
+            result = self._message(chat_id, photo=self._photo_sizes())
+        elif method == "sendDocument":
+            self.file_id += 1
+            result = self._message(chat_id, document={"file_id": f"doc_{self.file_id}",
+                                                      "file_unique_id": f"d{self.file_id}"})
+        elif method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            result = [self._message(chat_id, photo=self._photo_sizes()) for _ in media]
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=params.get("text", ""))
+        else:
+            result = True
+        self.chat_queue(int(chat_id)).put_nowait((method, params.get("text") or params.get("caption") or "",
+                                                  time.perf_counter()))
+        return result
+
+    # Длинный опрос: отдаём накопленные обновления или ждём новых до timeout
+    async def _get_updates(self, offset: int, timeout: float) -> list:
+        self.first_poll.set()
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+
+def _parse_params(content_type: str, body: bytes) -> dict:
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if name and not part.get_filename():
+                params[name] = part.get_payload(decode=True).decode(errors="replace")
+        return params
+    if content_type.startswith("application/json"):
+        return {key: value if isinstance(value, str) else json.dumps(value)
+                for key, value in json.loads(body or b"{}").items()}
+    return {key: values[0] for key, values in parse_qs(body.decode()).items()}
@@ -0,0 +1,216 @@
+import io
+import os
+import sys
+import time
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+import urllib.request
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import metrics
+from access import MAIN_ADMINS
+from bench.fake_api import FakeBotAPI
+
+# Нагрузочный прогон: бот запускается отдельным процессом против локальной
+# замены Bot API, ученики регистрируются и присылают скриншоты, админы
+# одновременно листают классы и выгружают архивы.
+# Запуск: python -m bench.loadgen --students 200 --admins 3 --classes 10 --uploads 2 [--workers 4]
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+STEP_TIMEOUT = 60
+STUDENT_ID_BASE = 10 ** 9
+
+
+class Simulation:
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+        self.latencies = {}
+        self.timeouts = {}
+        self._callbacks = 0
+        self._messages = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        self._messages += 1
+        message = {"message_id": self._messages, "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        message.update(fields)
+        return message
+
+    # Ожидание ответа бота с одной из ожидаемых подстрок; остальные вызовы в чат пропускаются
+    async def _expect(self, user_id: int, step: str, started: float, expected: tuple):
+        queue = self.api.chat_queue(user_id)
+        deadline = started + STEP_TIMEOUT
+        while True:
+            try:
+                _, text, received = await asyncio.wait_for(queue.get(), max(0.0, deadline - time.perf_counter()))
+            except asyncio.TimeoutError:
+                self.timeouts[step] = self.timeouts.get(step, 0) + 1
+                return
+            if any(part in text for part in expected):
+                self.latencies.setdefault(step, []).append(received - started)
+                return
+
+    async def send_text(self, user_id: int, step: str, text: str, *expected):
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        started = time.perf_counter()
+        self.api.push_update({"message": self._message(user_id, **fields)})
+        await self._expect(user_id, step, started, expected)
+
+    async def press(self, user_id: int, step: str, data: str, *expected):
+        self._callbacks += 1
+        update = {"callback_query": {"id": f"{user_id}_{self._callbacks}", "from": self._user(user_id),
+                                     "chat_instance": str(user_id), "data": data,
+                                     "message": self._message(user_id, text="menu")}}
+        started = time.perf_counter()
+        self.api.push_update(update)
+        await self._expect(user_id, step, started, expected)
+
+    async def send_photo(self, user_id: int, step: str, data: bytes, *expected):
+        started = time.perf_counter()
+        self.api.push_update({"message": self._message(user_id, photo=[self.api.add_file(data)])})
+        await self._expect(user_id, step, started, expected)
+
+
+# Уникальная картинка на каждую загрузку, чтобы не срабатывала проверка дублей
+def make_photo(seed: int) -> bytes:
+    if Image is None:
+        return random.Random(seed).randbytes(200 * 1024)
+    image = Image.effect_noise((720, 1280), 64).convert("RGB")
+    image.putpixel((seed % 720, seed // 720 % 1280), (seed % 256, 0, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+async def setup_classes(sim: Simulation, admin_id: int, classes: list):
+    for class_name in classes:
+        await sim.press(admin_id, "add_class", "add_class", "Введите название")
+        await sim.send_text(admin_id, "save_class", class_name, "успешно добавлен")
+
+
+async def student(sim: Simulation, user_id: int, class_name: str, uploads: int):
+    await sim.send_text(user_id, "start", "/start", "Введите ваше имя")
+    await sim.send_text(user_id, "first_name", "Иван", "фамилию")
+    await sim.send_text(user_id, "last_name", f"Ученик{user_id}", "Выберите ваш класс")
+    await sim.press(user_id, "pick_class", class_name, "Выберите действие")
+    for n in range(uploads):
+        await sim.press(user_id, "upload_prompt", "upload_screenshot", "Пришлите скриншот")
+        photo = await asyncio.to_thread(make_photo, user_id * 100 + n)
+        await sim.send_photo(user_id, "upload_photo", photo, "Скриншот принят", "успешно сохранён", "уже был загружен")
+
+
+async def admin(sim: Simulation, admin_id: int, classes: list, done: asyncio.Event):
+    while not done.is_set():
+        class_name = random.choice(classes)
+        await sim.send_text(admin_id, "admin_menu", "/sqlallget", "Выберите действие")
+        await sim.send_text(admin_id, "find", f"/find Ученик{STUDENT_ID_BASE + random.randrange(100)}",
+                            "Найдено", "Никого не найдено")
+        await sim.press(admin_id, "class_roster", f"class_{class_name}", "Список учеников", "нет учеников")
+        await sim.press(admin_id, "download_class", f"download_class_{class_name}", "Архив отправлен", "Нет фотографий")
+
+
+def fetch_metrics(port: int) -> str:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            return response.read().decode()
+    except OSError:
+        return ""
+
+
+# Гистограмма задержки цикла событий бота из его /metrics
+def loop_lag(text: str):
+    histogram = metrics.Histogram("bench_loop_lag", "")
+    cumulative, total = [], 0.0
+    for line in text.splitlines():
+        if line.startswith("bot_event_loop_lag_seconds_bucket"):
+            cumulative.append(int(float(line.rsplit(" ", 1)[1])))
+        elif line.startswith("bot_event_loop_lag_seconds_sum"):
+            total = float(line.rsplit(" ", 1)[1])
+    if not cumulative:
+        return None
+    series = [count - previous for count, previous in zip(cumulative, [0] + cumulative[:-1])] + [total]
+    return histogram, series
+
+
+def report(sim: Simulation, elapsed: float, metrics_text: str):
+    steps = sum(len(values) for values in sim.latencies.values())
+    print(f"Шагов: {steps} за {elapsed:.1f} с ({steps / elapsed:.1f}/с)")
+    for step, values in sim.latencies.items():
+        values.sort()
+        print(f"  {step:<16} n={len(values):<6} p50={values[len(values) // 2] * 1000:8.1f} мс  "
+              f"p99={values[min(len(values) - 1, int(len(values) * 0.99))] * 1000:8.1f} мс")
+    for step, count in sim.timeouts.items():
+        print(f"  {step:<16} без ответа за {STEP_TIMEOUT} с: {count}")
+    lag = loop_lag(metrics_text)
+    if lag:
+        histogram, series = lag
+        count = sum(series[:-1])
+        print(f"Задержка цикла событий: замеров {count}, p50={histogram.quantile(series, 0.5) * 1000:.1f} мс, "
+              f"p99={histogram.quantile(series, 0.99) * 1000:.1f} мс, "
+              f"в среднем {series[-1] / max(count, 1) * 1000:.1f} мс")
+
+
+async def run(args):
+    api = FakeBotAPI()
+    port = await api.start()
+    metrics_port = random.randint(20000, 60000)
+    workdir = tempfile.mkdtemp(prefix="bot_bench_")
+    env = dict(os.environ, BOT_TOKEN="123456:bench", TELEGRAM_API_URL=f"http://127.0.0.1:{port}",
+               BOT_MODE="polling", METRICS_PORT=str(metrics_port), BOT_WORKERS=str(args.workers))
+    process = await asyncio.create_subprocess_exec(sys.executable, BOT_PATH, cwd=workdir, env=env)
+    print(f"Бот запущен (pid {process.pid}), рабочая папка {workdir}")
+    try:
+        await asyncio.wait_for(api.first_poll.wait(), 30)
+        sim = Simulation(api)
+        admins = sorted(MAIN_ADMINS)[:max(1, args.admins)]
+        classes = [f"{grade}{letter}" for grade in range(5, 12) for letter in "АБВГ"][:args.classes]
+        await setup_classes(sim, admins[0], classes)
+        if args.workers > 1:
+            # другие рабочие процессы узнают о новых классах при очередной проверке версий кешей
+            await asyncio.sleep(1)
+
+        started = time.perf_counter()
+        done = asyncio.Event()
+        browsing = [asyncio.ensure_future(admin(sim, admin_id, classes, done)) for admin_id in admins]
+        await asyncio.gather(*[student(sim, STUDENT_ID_BASE + i, classes[i % len(classes)], args.uploads)
+                               for i in range(args.students)])
+        done.set()
+        await asyncio.gather(*browsing)
+        elapsed = time.perf_counter() - started
+        # в многопроцессном режиме задержка цикла берётся у первого рабочего процесса
+        lag_port = metrics_port + 1 if args.workers > 1 else metrics_port
+        report(sim, elapsed, await asyncio.to_thread(fetch_metrics, lag_port))
+        print(f"Вызовы Bot API: {dict(sorted(api.calls.items()))}")
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), 30)
+            except asyncio.TimeoutError:
+                process.kill()
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против локального Bot API")
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--admins", type=int, default=2)
+    parser.add_argument("--classes", type=int, default=5)
+    parser.add_argument("--uploads", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,75 +1,69 @@
 import os
-import sqlite3
-import shutil
-import zipfile
+import time
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters,
     CallbackQueryHandler, ContextTypes, ConversationHandler
 )
 
+import db
+import archive
+import dedupe
+import images
+import broadcast
+import ingest
+import access
+import search
+import report
+import packs
+import jobs
+import cluster
+import metrics
+from instrumentation import InstrumentedRequest, instrument_application
+from access import MAIN_ADMINS, admin_required, CLASS_ADMIN, FULL_ADMIN, MAIN_ADMIN
+from updates import PerUserUpdateProcessor
+from persistence import DbPersistence
+
 # Состояния для ConversationHandler
 GET_FIRST_NAME, GET_LAST_NAME, GET_CLASS, ADD_CLASS, ADD_ADMIN_ID, ADD_ADMIN_ACCESS, UPLOAD_SCREENSHOT, SET_MODO_URL = range(8)
 
-# Множество главных админов
-MAIN_ADMINS = {6897531034, 6176677671, 1552916570, 1040487188, 1380600483, 7176188474, 651856676}
-
 # Директории
 PHOTOS_DIR = "photos"
 TEMP_ZIP_DIR = "temp_zip"
 os.makedirs(PHOTOS_DIR, exist_ok=True)
 os.makedirs(TEMP_ZIP_DIR, exist_ok=True)
 
-# Удаление файла с задержкой
-async def delete_file_after_delay(file_path: str, delay: int):
-    await asyncio.sleep(delay)
-    os.remove(file_path)
+# Токен бота и адрес Bot API (другой адрес — например, локальная замена для нагрузочных тестов)
+TOKEN = os.environ.get("BOT_TOKEN")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+# Режим получения обновлений: polling или webhook (встроенный веб-сервер PTB).
+# С BOT_WORKERS > 1 обновления получает главный процесс и раздаёт их рабочим (cluster.py)
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK = dict(
+    listen=os.environ.get("WEBHOOK_LISTEN", "127.0.0.1"),
+    port=int(os.environ.get("WEBHOOK_PORT", "8443")),
+    url_path=os.environ.get("WEBHOOK_PATH", "telegram"),
+    webhook_url=os.environ.get("WEBHOOK_URL"),
+    secret_token=os.environ.get("WEBHOOK_SECRET"),
+)
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "64"))
+
+# Локальная точка метрик в формате Prometheus; порт 0 — отключена
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
 
 # Инициализация базы данных
-def init_db():
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS students (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER UNIQUE,
-        first_name TEXT,
-        last_name TEXT,
-        class TEXT,
-        username TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS classes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS admins (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER UNIQUE,
-        username TEXT,
-        class_access TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS screenshots (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        file_path TEXT,
-        timestamp TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT)''')
-    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('modo_url', 'https://class-kz.ru/ucheniku/modo-4-klass/')")
-    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('modo_active', 'true')")
-    conn.commit()
-    conn.close()
-
-init_db()
+db.init_db()
 
 # Начало регистрации
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM students WHERE user_id = ?", (user_id,))
-    student = cursor.fetchone()
-    conn.close()
+    student = await db.get_student(user_id)
     if student:
         await update.message.reply_text("🎉 Вы уже зарегистрированы! Вот ваше меню:")
         await student_menu(update, context)
@@ -85,11 +79,7 @@ async def get_first_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def get_last_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['last_name'] = update.message.text.strip()
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM classes")
-    classes = [row[0] for row in cursor.fetchall()]
-    conn.close()
+    classes = await db.get_classes()
     if not classes:
         await update.message.reply_text("⚠️ Нет классов. Обратитесь к администратору.")
         return ConversationHandler.END
@@ -106,41 +96,39 @@ async def get_class(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_name = context.user_data.get('first_name')
     last_name = context.user_data.get('last_name')
     username = query.from_user.username or ""
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO students (user_id, first_name, last_name, class, username) VALUES (?, ?, ?, ?, ?)",
-                   (user_id, first_name, last_name, class_name, username))
-    conn.commit()
-    conn.close()
+    student_id = await db.add_student(user_id, first_name, last_name, class_name, username)
+    if student_id:
+        search.add(student_id, first_name, last_name, username, class_name)
     await query.edit_message_text(f"✅ Спасибо, {first_name} {last_name}! Вы зарегистрированы в классе {class_name}.")
     await student_menu(update, context)
     return ConversationHandler.END
 
 # Админский функционал
-async def sql_all_get(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    if user_id not in MAIN_ADMINS:
-        await update.message.reply_text("🚫 У вас нет доступа к этой команде.")
-        return
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM classes")
-    classes = [row[0] for row in cursor.fetchall()]
-    conn.close()
+# Главное меню админа: только доступные ему классы, общие действия — по уровню доступа
+async def admin_menu(user_id: int) -> InlineKeyboardMarkup:
+    classes = access.filter_classes(user_id, await db.get_classes())
     keyboard = [[InlineKeyboardButton(classes[i], callback_data=f"class_{classes[i]}"),
                  InlineKeyboardButton(classes[i + 1], callback_data=f"class_{classes[i + 1]}")]
                 for i in range(0, len(classes) - 1, 2)]
     if len(classes) % 2:
         keyboard.append([InlineKeyboardButton(classes[-1], callback_data=f"class_{classes[-1]}")])
-    keyboard.extend([
-        [InlineKeyboardButton("➕ Добавить класс", callback_data="add_class")],
-        [InlineKeyboardButton("👤 Управление администраторами", callback_data="manage_admins")],
-        [InlineKeyboardButton("📥 Скачать все фотографии", callback_data="download_all_photos")],
-        [InlineKeyboardButton("⚙️ Настройки MODO", callback_data="modo_settings")]
-    ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if user_id in MAIN_ADMINS:
+        keyboard.extend([
+            [InlineKeyboardButton("➕ Добавить класс", callback_data="add_class")],
+            [InlineKeyboardButton("👤 Управление администраторами", callback_data="manage_admins")]
+        ])
+    if access.has_full_access(user_id):
+        keyboard.append([InlineKeyboardButton("📥 Скачать все фотографии", callback_data="download_all_photos")])
+    if user_id in MAIN_ADMINS:
+        keyboard.append([InlineKeyboardButton("⚙️ Настройки MODO", callback_data="modo_settings")])
+    return InlineKeyboardMarkup(keyboard)
+
+@admin_required(CLASS_ADMIN)
+async def sql_all_get(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply_markup = await admin_menu(update.message.from_user.id)
     await update.message.reply_text("🔧 Выберите действие:", reply_markup=reply_markup)
 
+@admin_required(MAIN_ADMIN)
 async def admin_add_class(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     await update.callback_query.message.reply_text("🏫 Введите название нового класса:")
@@ -151,15 +139,12 @@ async def save_new_class(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not new_class:
         await update.message.reply_text("⚠️ Название класса не может быть пустым. Попробуйте ещё раз:")
         return ADD_CLASS
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO classes (name) VALUES (?)", (new_class,))
-    conn.commit()
-    conn.close()
+    await db.add_class(new_class)
     os.makedirs(os.path.join(PHOTOS_DIR, new_class), exist_ok=True)
     await update.message.reply_text(f"✅ Класс '{new_class}' успешно добавлен!")
     return ConversationHandler.END
 
+@admin_required(MAIN_ADMIN)
 async def manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     keyboard = [
@@ -169,6 +154,7 @@ async def manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.callback_query.message.edit_text("👤 Управление администраторами:", reply_markup=reply_markup)
 
+@admin_required(MAIN_ADMIN)
 async def admin_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     await update.callback_query.message.reply_text("🆔 Введите ID нового администратора:")
@@ -184,135 +170,408 @@ async def save_admin_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     access_input = update.message.text.strip()
     class_access = "all" if access_input.lower() == 'all' else ",".join([cls.strip() for cls in access_input.split(',')])
     admin_id = context.user_data.get('new_admin_id')
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO admins (user_id, class_access) VALUES (?, ?)", (admin_id, class_access))
-    conn.commit()
-    conn.close()
+    await db.save_admin(admin_id, class_access)
+    access.grant(admin_id, class_access)
     await update.message.reply_text(f"✅ Администратор {admin_id} добавлен с доступом: {class_access}")
     return ConversationHandler.END
 
+@admin_required(CLASS_ADMIN)
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM classes")
-    classes = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    keyboard = [[InlineKeyboardButton(classes[i], callback_data=f"class_{classes[i]}"),
-                 InlineKeyboardButton(classes[i + 1], callback_data=f"class_{classes[i + 1]}")]
-                for i in range(0, len(classes) - 1, 2)]
-    if len(classes) % 2:
-        keyboard.append([InlineKeyboardButton(classes[-1], callback_data=f"class_{classes[-1]}")])
-    keyboard.extend([
-        [InlineKeyboardButton("➕ Добавить класс", callback_data="add_class")],
-        [InlineKeyboardButton("👤 Управление администраторами", callback_data="manage_admins")],
-        [InlineKeyboardButton("📥 Скачать все фотографии", callback_data="download_all_photos")],
-        [InlineKeyboardButton("⚙️ Настройки MODO", callback_data="modo_settings")]
-    ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = await admin_menu(query.from_user.id)
     await query.message.edit_text("🔧 Выберите действие:", reply_markup=reply_markup)
 
+# Листание списков: в callback_data — направление и id крайней строки страницы,
+# например roster_n120_5А — следующая страница класса 5А после ученика 120
+ROSTER_PAGE_SIZE = 20
+SCREENSHOTS_PAGE_SIZE = 10
+MY_SCREENSHOTS_PAGE_SIZE = 20
+
+def parse_page(token: str):
+    return token[0] == "p", int(token[1:])
+
+def page_buttons(prefix: str, rows: list, has_prev: bool, has_next: bool, suffix: str = "") -> list:
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{prefix}_p{rows[0][0]}{suffix}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Далее ➡️", callback_data=f"{prefix}_n{rows[-1][0]}{suffix}"))
+    return nav
+
+@admin_required(CLASS_ADMIN)
 async def show_class_students(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    class_name = query.data.split("_", 1)[1]
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT s.id, s.first_name, s.last_name,
-               (SELECT MAX(timestamp) FROM screenshots WHERE user_id = s.user_id) as last_upload,
-               (SELECT COUNT(*) FROM screenshots WHERE user_id = s.user_id) as screenshot_count
-        FROM students s WHERE s.class = ?
-    """, (class_name,))
-    students = cursor.fetchall()
-    conn.close()
+    if query.data.startswith("roster_"):
+        _, token, class_name = query.data.split("_", 2)
+        backward, key = parse_page(token)
+    else:
+        class_name = query.data.split("_", 1)[1]
+        backward, key = False, 0
+    if not access.can_access_class(query.from_user.id, class_name):
+        await access.deny(update)
+        return
+    students, has_prev, has_next = await db.get_class_roster(class_name, key, backward, ROSTER_PAGE_SIZE)
+    if not students and key:
+        students, has_prev, has_next = await db.get_class_roster(class_name, page_size=ROSTER_PAGE_SIZE)
     if not students:
         await query.answer("👥 В этом классе нет учеников.", show_alert=True)
         return
     keyboard = [[InlineKeyboardButton(f"{fn} {ln} (скриншотов: {sc}, послед.: {lu or 'Нет данных'})",
                                      callback_data=f"student_{sid}")] for sid, fn, ln, lu, sc in students]
+    nav = page_buttons("roster", students, has_prev, has_next, f"_{class_name}")
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🖼 Обзорный лист класса", callback_data=f"sheet_{class_name}")])
     keyboard.append([InlineKeyboardButton("📥 Скачать все скриншоты", callback_data=f"download_class_{class_name}")])
+    keyboard.append([InlineKeyboardButton("📊 Отчёт о сдаче", callback_data=f"report_{class_name}")])
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(f"👥 Список учеников класса {class_name}:", reply_markup=reply_markup)
 
+# Поиск ученика по всем доступным классам: /find <имя или фамилия>
+@admin_required(CLASS_ADMIN)
+async def find_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = " ".join(context.args)
+    if not text:
+        await update.message.reply_text("🔍 Использование: /find <имя, фамилия или username>")
+        return
+    admin_id = update.effective_user.id
+    found = search.find(text, accept=lambda class_name: access.can_access_class(admin_id, class_name))
+    if not found:
+        await update.message.reply_text("🔍 Никого не найдено.")
+        return
+    keyboard = [[InlineKeyboardButton(f"{fn} {ln} ({cls})", callback_data=f"student_{sid}")]
+                for sid, fn, ln, cls in found]
+    await update.message.reply_text(f"🔍 Найдено по запросу «{text}»:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@admin_required(CLASS_ADMIN)
 async def show_student_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    student_id = int(query.data.split("_")[1])
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT first_name, last_name, class, username, user_id FROM students WHERE id = ?", (student_id,))
-    student = cursor.fetchone()
+    if query.data.startswith("shots_"):
+        _, token, student_id = query.data.split("_")
+        backward, key = parse_page(token)
+    else:
+        student_id = query.data.split("_")[1]
+        backward, key = False, 0
+    student_id = int(student_id)
+    student = await db.get_student_by_id(student_id)
     if not student:
         await query.answer("👤 Студент не найден.", show_alert=True)
         return
     first_name, last_name, class_name, username, user_id = student
+    if not access.can_access_class(query.from_user.id, class_name):
+        await access.deny(update)
+        return
     profile_text = f"👤 Имя: {first_name}\n👤 Фамилия: {last_name}\n🏫 Класс: {class_name}\n📱 Телеграм: @{username or 'Не указан'}"
-    cursor.execute("SELECT id, timestamp FROM screenshots WHERE user_id = ?", (user_id,))
-    screenshots = cursor.fetchall()
-    conn.close()
-    keyboard = [[InlineKeyboardButton(f"📷 Скрин {i+1} ({ts})", callback_data=f"view_screenshot_{sc_id}")] for i, (sc_id, ts) in enumerate(screenshots)]
+    screenshots, has_prev, has_next = await db.get_student_screenshots(user_id, key, backward, SCREENSHOTS_PAGE_SIZE)
+    if not screenshots and key:
+        screenshots, has_prev, has_next = await db.get_student_screenshots(user_id, page_size=SCREENSHOTS_PAGE_SIZE)
+    keyboard = [[InlineKeyboardButton(f"📷 Скрин ({ts})", callback_data=f"view_screenshot_{sc_id}")] for sc_id, ts in screenshots]
+    nav = page_buttons("shots", screenshots, has_prev, has_next, f"_{student_id}")
+    if nav:
+        keyboard.append(nav)
     if screenshots:
+        keyboard.append([InlineKeyboardButton("🖼 Показать все скриншоты", callback_data=f"album_{user_id}")])
         keyboard.append([InlineKeyboardButton("📥 Скачать все скриншоты", callback_data=f"download_student_{user_id}")])
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"class_{class_name}")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(profile_text, reply_markup=reply_markup)
 
+def read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+# Блокирующая операция в потоке с замером времени
+async def run_io(op: str, fn, *args):
+    with metrics.timer(metrics.IO_SECONDS, op=op):
+        return await asyncio.to_thread(fn, *args)
+
+# Фото с диска или из пак-файла — только если у Telegram нет копии по file_id
+async def read_photo(file_path: str, where: tuple = None):
+    if not file_path:
+        return None
+    return await run_io("read_photo", packs.read, file_path, where)
+
+@admin_required(CLASS_ADMIN)
 async def view_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     sc_id = int(query.data.split("_")[2])
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT file_path FROM screenshots WHERE id = ?", (sc_id,))
-    file_path = cursor.fetchone()[0]
-    conn.close()
-    if not os.path.exists(file_path):
+    screenshot = await db.get_screenshot(sc_id)
+    if not screenshot:
+        await query.answer("📷 Скриншот не найден.", show_alert=True)
+        return
+    file_path, file_id, class_name, *where = screenshot
+    if not access.can_access_class(query.from_user.id, class_name):
+        await access.deny(update)
+        return
+    if file_id:
+        try:
+            await context.bot.send_photo(query.message.chat_id, photo=file_id)
+            await query.answer()
+            return
+        except BadRequest:
+            pass
+    photo = await read_photo(file_path, packs.location(*where))
+    if photo is None:
         await query.answer("📷 Скриншот не найден.", show_alert=True)
         return
-    await context.bot.send_photo(query.message.chat_id, photo=open(file_path, 'rb'))
+    message = await context.bot.send_photo(query.message.chat_id, photo=photo)
+    await db.set_screenshot_file_id(sc_id, message.photo[-1].file_id)
+    await query.answer()
 
+# Все скриншоты ученика альбомами по 10 фото
+MEDIA_GROUP_SIZE = 10
+
+# Группа альбома: (id скриншота, использованный file_id, InputMediaPhoto)
+async def album_batch(rows: list, use_file_ids: bool) -> list:
+    batch = []
+    for sc_id, file_path, file_id, ts, *where in rows:
+        file_id = file_id if use_file_ids else None
+        photo = file_id or await read_photo(file_path, packs.location(*where))
+        if photo is not None:
+            batch.append((sc_id, file_id, InputMediaPhoto(photo, caption=ts)))
+    return batch
+
+@admin_required(CLASS_ADMIN)
+async def show_student_album(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = int(query.data.split("_")[1])
+    # класс ученика приходит вместе с фото: доступ проверяется без отдельного запроса
+    class_name, photos = await db.get_student_photos(user_id)
+    if not photos:
+        await query.answer("📷 Нет скриншотов.", show_alert=True)
+        return
+    if not access.can_access_class(query.from_user.id, class_name):
+        await access.deny(update)
+        return
+    await query.answer()
+    for i in range(0, len(photos), MEDIA_GROUP_SIZE):
+        rows = photos[i:i + MEDIA_GROUP_SIZE]
+        batch = await album_batch(rows, use_file_ids=True)
+        if not batch:
+            continue
+        try:
+            messages = await context.bot.send_media_group(query.message.chat_id, media=[media for _, _, media in batch])
+        except BadRequest:
+            # устаревший file_id ломает всю группу: отправляем её заново из файлов
+            batch = await album_batch(rows, use_file_ids=False)
+            if not batch:
+                continue
+            messages = await context.bot.send_media_group(query.message.chat_id, media=[media for _, _, media in batch])
+        for (sc_id, file_id, _), message in zip(batch, messages):
+            if not file_id and message.photo:
+                await db.set_screenshot_file_id(sc_id, message.photo[-1].file_id)
+
+# Плитки обзорного листа (подпись, путь, байты): упакованные файлы читаются здесь,
+# процессы рисования открывают только отдельные файлы и миниатюры
+def sheet_tiles(rows) -> list:
+    return [(f"{fn} {ln}", path, packs.read(path, packs.location(*where)) if where[0] else None)
+            for fn, ln, path, *where in rows]
+
+# Обзорный лист: последний скриншот каждого ученика класса одной картинкой
+@admin_required(CLASS_ADMIN)
+async def class_contact_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    class_name = query.data.split("_", 1)[1]
+    if not access.can_access_class(query.from_user.id, class_name):
+        await access.deny(update)
+        return
+    if not images.AVAILABLE:
+        await query.answer("⚠️ Обработка изображений недоступна на сервере.", show_alert=True)
+        return
+    rows = await db.get_class_latest_screenshots(class_name)
+    if not rows:
+        await query.answer("👥 В этом классе нет учеников.", show_alert=True)
+        return
+    await query.answer("⏳ Готовлю обзорный лист...")
+    with metrics.timer(metrics.IO_SECONDS, op="contact_sheet"):
+        tiles = await run_io("sheet_tiles", sheet_tiles, rows)
+        sheets = await images.contact_sheets(tiles)
+    for index, sheet in enumerate(sheets, start=1):
+        caption = f"🏫 {class_name}" + (f" ({index}/{len(sheets)})" if len(sheets) > 1 else "")
+        await context.bot.send_photo(query.message.chat_id, photo=sheet, caption=caption)
+
+# Кеш архивов для выгрузок
+archive_cache = archive.ArchiveCache(os.path.join(TEMP_ZIP_DIR, "cache"))
+
+# Отчёт о ходе сборки из рабочего потока, не чаще раза в пару секунд
+def build_progress(status, loop):
+    last_report = [0.0]
+
+    def on_progress(done, total):
+        now = time.monotonic()
+        if done != total and now - last_report[0] < 2:
+            return
+        last_report[0] = now
+        asyncio.run_coroutine_threadsafe(status.edit_text(f"📦 Добавлено в архив: {done}/{total} файлов"), loop)
+    return on_progress
+
+# Строки (id, путь, место в паке) в записи архива; файл, общий для нескольких строк
+# после связывания дублей, получает в архиве уникальное имя
+def archive_entries(rows, arcname) -> list:
+    entries, seen = [], set()
+    for sc_id, path, *where in rows:
+        name = arcname(path)
+        if name in seen:
+            root, ext = os.path.splitext(name)
+            name = f"{root}_{sc_id}{ext}"
+        seen.add(name)
+        entries.append((sc_id, name, path, packs.location(*where)))
+    return entries
+
+# Отправка архива по частям: уже отправленные части уходят по file_id
+async def send_archive(query, scope: str, entries: list, name: str):
+    await query.answer("⏳ Собираю архив...")
+    status = await query.message.reply_text(f"📦 Подготовка архива ({len(entries)} файлов)...")
+    with metrics.timer(metrics.IO_SECONDS, op="archive_build"):
+        parts = await archive_cache.get(scope, entries, build_progress(status, asyncio.get_running_loop()))
+    for index, part in enumerate(parts, start=1):
+        filename = archive.part_filename(name, index, len(parts))
+        await status.edit_text(f"📤 Отправка части {index}/{len(parts)}...")
+        if part["file_id"] and part["sent_as"] == filename:
+            await query.message.reply_document(document=part["file_id"])
+            continue
+        data = await run_io("read_archive", read_file, part["path"])
+        message = await query.message.reply_document(document=data, filename=filename)
+        await archive_cache.remember_file_id(scope, part, message.document.file_id, filename)
+    await status.edit_text(f"📤 Архив отправлен (частей: {len(parts)}).")
+
+@admin_required(CLASS_ADMIN)
 async def download_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = int(query.data.split("_")[2])
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT file_path FROM screenshots WHERE user_id = ?", (user_id,))
-    files = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    if not files:
+    class_name, rows = await db.get_student_manifest(user_id)
+    if not rows:
         await query.answer("📷 Нет скриншотов для скачивания.", show_alert=True)
         return
-    zip_file = os.path.join(TEMP_ZIP_DIR, f"student_{user_id}_screenshots.zip")
-    with zipfile.ZipFile(zip_file, 'w') as zf:
-        for file in files:
-            zf.write(file, os.path.basename(file))
-    await query.message.reply_document(document=open(zip_file, 'rb'), filename=f"student_{user_id}_screenshots.zip")
-    await query.answer("📤 Архив отправлен.")
-    asyncio.create_task(delete_file_after_delay(zip_file, 300))
+    if not access.can_access_class(query.from_user.id, class_name):
+        await access.deny(update)
+        return
+    entries = archive_entries(rows, os.path.basename)
+    await send_archive(query, f"student_{user_id}", entries, f"student_{user_id}_screenshots")
 
+@admin_required(CLASS_ADMIN)
 async def download_class(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    class_name = query.data.split("_", 1)[1]
-    class_folder = os.path.join(PHOTOS_DIR, class_name)
-    if not os.path.isdir(class_folder):
+    class_name = query.data.split("_", 2)[2]
+    if not access.can_access_class(query.from_user.id, class_name):
+        await access.deny(update)
+        return
+    rows = await db.get_class_manifest(class_name)
+    if not rows:
         await query.answer("📷 Нет фотографий для данного класса.", show_alert=True)
         return
-    base_name = os.path.join(TEMP_ZIP_DIR, f"{class_name}_screenshots")
-    shutil.make_archive(base_name, 'zip', class_folder)
-    zip_file = base_name + ".zip"
-    await query.message.reply_document(document=open(zip_file, 'rb'), filename=f"{class_name}_screenshots.zip")
-    await query.answer("📤 Архив отправлен.")
-    asyncio.create_task(delete_file_after_delay(zip_file, 300))
+    entries = archive_entries(rows, os.path.basename)
+    await send_archive(query, f"class_{class_name}", entries, f"{class_name}_screenshots")
 
+@admin_required(FULL_ADMIN)
 async def download_all_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    base_name = os.path.join(TEMP_ZIP_DIR, "all_photos")
-    shutil.make_archive(base_name, 'zip', PHOTOS_DIR)
-    zip_file = base_name + ".zip"
-    await query.message.reply_document(document=open(zip_file, 'rb'), filename="all_photos.zip")
-    await query.answer("📤 Архив отправлен.")
-    asyncio.create_task(delete_file_after_delay(zip_file, 300))
+    rows = await db.get_all_manifest()
+    if not rows:
+        await query.answer("📷 Нет фотографий для скачивания.", show_alert=True)
+        return
+    entries = archive_entries(rows, lambda path: os.path.relpath(path, PHOTOS_DIR))
+    await send_archive(query, "all", entries, "all_photos")
+
+# Отчёт о сдаче: файл собирается в потоке чтения базы, затем уходит документом
+async def send_report(message, class_name, fmt: str):
+    if fmt == "xlsx" and not report.XLSX_AVAILABLE:
+        fmt = "csv"
+    name = f"report_{class_name or 'all'}_{datetime.now(ZoneInfo('Asia/Almaty')).strftime('%Y-%m-%d')}.{fmt}"
+    path = os.path.join(TEMP_ZIP_DIR, f"{time.monotonic_ns()}_{name}")
+    try:
+        count = await report.build(path, class_name, fmt)
+        if not count:
+            await message.reply_text("👥 Нет учеников для отчёта.")
+            return
+        data = await run_io("read_report", read_file, path)
+        await message.reply_document(document=data, filename=name,
+                                     caption=f"📊 Отчёт о сдаче: {class_name or 'вся школа'} (учеников: {count})")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+# /report [класс] [csv|xlsx]: без класса — по всей школе
+@admin_required(CLASS_ADMIN)
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    fmt = args.pop().lower() if args and args[-1].lower() in ("csv", "xlsx") else "xlsx"
+    class_name = " ".join(args) or None
+    admin_id = update.effective_user.id
+    if class_name is None and not access.has_full_access(admin_id):
+        await access.deny(update)
+        return
+    if class_name is not None:
+        if class_name not in await db.get_classes():
+            await update.message.reply_text(f"⚠️ Класс '{class_name}' не найден.")
+            return
+        if not access.can_access_class(admin_id, class_name):
+            await access.deny(update)
+            return
+    await send_report(update.message, class_name, fmt)
+
+@admin_required(CLASS_ADMIN)
+async def class_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    class_name = query.data.split("_", 1)[1]
+    if not access.can_access_class(query.from_user.id, class_name):
+        await access.deny(update)
+        return
+    await query.answer("⏳ Готовлю отчёт...")
+    await send_report(query.message, class_name, "xlsx")
+
+# Начало периода для аналитики: дата из последнего аргумента, иначе день активации MODO,
+# иначе неделя назад. Второе значение — был ли последний аргумент датой
+async def parse_since(args: list) -> tuple:
+    if args:
+        try:
+            return datetime.strptime(args[-1], "%Y-%m-%d").strftime("%Y-%m-%d"), True
+        except ValueError:
+            pass
+    activated = await db.get_setting('modo_activated_at')
+    if activated:
+        return datetime.fromtimestamp(int(activated), ZoneInfo("Asia/Almaty")).strftime("%Y-%m-%d"), False
+    return (datetime.now(ZoneInfo("Asia/Almaty")) - timedelta(days=7)).strftime("%Y-%m-%d"), False
+
+# /missing [класс] [ГГГГ-ММ-ДД]: кто ничего не прислал с указанной даты
+@admin_required(CLASS_ADMIN)
+async def not_submitted(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    since, dated = await parse_since(args)
+    if dated:
+        args.pop()
+    class_name = " ".join(args) or None
+    admin_id = update.effective_user.id
+    if class_name is not None:
+        if class_name not in await db.get_classes():
+            await update.message.reply_text(f"⚠️ Класс '{class_name}' не найден.")
+            return
+        if not access.can_access_class(admin_id, class_name):
+            await access.deny(update)
+            return
+    rows = [row for row in await db.get_not_submitted(class_name, since) if access.can_access_class(admin_id, row[3])]
+    if not rows:
+        await update.message.reply_text(f"✅ С {since} все ученики прислали скриншоты.")
+        return
+    lines = [f"📭 Не сдали с {since} ({len(rows)}):"]
+    lines += [f"{cls} · {ln} {fn} (последний: {last or 'нет'})" for _, fn, ln, cls, last in rows]
+    await update.message.reply_text("\n".join(lines)[:4096])
+
+# /completion [ГГГГ-ММ-ДД]: доля сдавших по классам
+@admin_required(CLASS_ADMIN)
+async def class_completion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    since, _ = await parse_since(context.args)
+    admin_id = update.effective_user.id
+    rows = [row for row in await db.get_class_completion(since) if access.can_access_class(admin_id, row[0])]
+    if not rows:
+        await update.message.reply_text("👥 Нет учеников.")
+        return
+    lines = [f"📈 Сдача с {since}:"]
+    lines += [f"{cls}: {submitted}/{total} ({submitted * 100 // total}%), загрузок: {uploads}"
+              for cls, total, submitted, uploads in rows]
+    await update.message.reply_text("\n".join(lines)[:4096])
 
 # Загрузка скриншотов от школьников
 async def upload_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -323,37 +582,59 @@ async def upload_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def save_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    photo_file = await update.message.photo[-1].get_file()
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT class FROM students WHERE user_id = ?", (user_id,))
-    student_class = cursor.fetchone()
-    if not student_class:
+    photo = update.message.photo[-1]
+    class_name = await db.get_student_class(user_id)
+    if not class_name:
         await update.message.reply_text("⚠️ Вы не зарегистрированы.")
-        conn.close()
         return ConversationHandler.END
-    class_name = student_class[0]
-    class_folder = os.path.join(PHOTOS_DIR, class_name)
-    os.makedirs(class_folder, exist_ok=True)
     timestamp = datetime.now(ZoneInfo("Asia/Almaty")).strftime("%Y-%m-%d_%H-%M-%S")
-    file_path = os.path.join(class_folder, f"{user_id}_{timestamp}.jpg")
-    await photo_file.download_to_drive(file_path)
-    cursor.execute("INSERT INTO screenshots (user_id, file_path, timestamp) VALUES (?, ?, ?)",
-                   (user_id, file_path, timestamp))
-    conn.commit()
-    conn.close()
-    await update.message.reply_text("✅ Скриншот успешно сохранён!")
+    # Тот же файл Telegram уже был прислан: ничего не скачиваем
+    existing = await db.find_by_unique_id(photo.file_unique_id, user_id)
+    if existing and existing[1] == user_id:
+        await update.message.reply_text("ℹ️ Этот скриншот уже был загружен.")
+        return ConversationHandler.END
+    if existing:
+        _, _, file_path, sha, phash = existing
+        await db.add_screenshot(user_id, file_path, timestamp, photo.file_id, photo.file_unique_id, sha, phash)
+        await update.message.reply_text("✅ Скриншот успешно сохранён!")
+        return ConversationHandler.END
+    # Скачивание — в очереди загрузок; ученик получает ответ сразу. file_unique_id
+    # в имени различает скриншоты, присланные в одну секунду
+    file_path = os.path.join(PHOTOS_DIR, class_name, f"{user_id}_{timestamp}_{photo.file_unique_id}.jpg")
+    upload = await db.add_pending_upload(user_id, update.effective_chat.id, photo.file_id, photo.file_unique_id,
+                                         file_path, timestamp)
+    if upload is None:
+        await update.message.reply_text("ℹ️ Этот скриншот уже был загружен.")
+        return ConversationHandler.END
+    await update.message.reply_text("✅ Скриншот принят и будет сохранён!")
+    await ingest.submit(upload)
     return ConversationHandler.END
 
+# Отчёт о похожих скриншотах внутри классов
+MAX_REPORT_PAIRS = 50
+
+@admin_required(FULL_ADMIN)
+async def duplicates_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = await db.get_phashes()
+    pairs = await asyncio.to_thread(dedupe.find_near_duplicates, rows)
+    if not pairs:
+        await update.message.reply_text("✅ Похожих скриншотов не найдено.")
+        return
+    names = await db.get_student_names()
+    lines = [f"🔍 Похожие скриншоты (пар: {len(pairs)}):"]
+    for distance, first, second in pairs[:MAX_REPORT_PAIRS]:
+        kind = "одинаковые" if distance == 0 else f"различие {distance}"
+        lines.append(f"🏫 {first[2]}: {names.get(first[1], first[1])} ({first[4]}) ↔ "
+                     f"{names.get(second[1], second[1])} ({second[4]}) — {kind}")
+    await update.message.reply_text("\n".join(lines)[:4096])
+
 # Настройки MODO
+@admin_required(MAIN_ADMIN)
 async def modo_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    modo_url = cursor.execute("SELECT value FROM settings WHERE key = 'modo_url'").fetchone()[0] or "Не установлена"
-    modo_active = cursor.execute("SELECT value FROM settings WHERE key = 'modo_active'").fetchone()[0] or "false"
-    conn.close()
+    modo_url = await db.get_setting('modo_url') or "Не установлена"
+    modo_active = await db.get_setting('modo_active') or "false"
     active_text = "✅ Да" if modo_active.lower() == 'true' else "❌ Нет"
     text = f"⚙️ Настройки MODO:\n\n🔗 Текущая ссылка: {modo_url}\n🔔 MODO активен: {active_text}"
     keyboard = [
@@ -361,11 +642,37 @@ async def modo_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("❌ Удалить ссылку на MODO", callback_data="remove_modo_url")],
         [InlineKeyboardButton("✅ Активировать MODO", callback_data="activate_modo")],
         [InlineKeyboardButton("🚫 Деактивировать MODO", callback_data="deactivate_modo")],
+        [InlineKeyboardButton("📣 Уведомить всех учеников", callback_data="broadcast_all")],
+        [InlineKeyboardButton("📣 Уведомить класс", callback_data="broadcast_pick")],
         [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(text, reply_markup=reply_markup)
 
+# Уведомление учеников о текущем состоянии MODO
+@admin_required(MAIN_ADMIN)
+async def broadcast_pick_class(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    classes = await db.get_classes()
+    keyboard = [[InlineKeyboardButton(cls, callback_data=f"broadcast_class_{cls}")] for cls in classes]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="modo_settings")])
+    await query.edit_message_text("📣 Выберите класс для уведомления:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@admin_required(MAIN_ADMIN)
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    class_name = query.data.split("_", 2)[2] if query.data.startswith("broadcast_class_") else None
+    modo_url = await db.get_setting('modo_url')
+    if await db.get_setting('modo_active') == 'true':
+        text = "📚 Задания MODO обновлены!" + (f"\n🔗 {modo_url}" if modo_url else "") + "\nОткройте /menu, чтобы перейти к заданиям."
+    else:
+        text = "🚫 Задания MODO сейчас недоступны."
+    status = await query.message.reply_text(f"📣 Рассылка {'классу ' + class_name if class_name else 'всем ученикам'} запущена...")
+    await broadcast.start(context.application, text, class_name, status.chat_id, status.message_id)
+
+@admin_required(MAIN_ADMIN)
 async def set_modo_url_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     await update.callback_query.message.reply_text("🔗 Введите новую ссылку на MODO:")
@@ -376,50 +683,35 @@ async def set_modo_url_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not new_url:
         await update.message.reply_text("⚠️ Ссылка не может быть пустой. Попробуйте ещё раз:")
         return SET_MODO_URL
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE settings SET value = ? WHERE key = 'modo_url'", (new_url,))
-    conn.commit()
-    conn.close()
+    await db.set_setting('modo_url', new_url)
     await update.message.reply_text(f"✅ Ссылка на MODO обновлена: {new_url}")
     return ConversationHandler.END
 
+@admin_required(MAIN_ADMIN)
 async def remove_modo_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE settings SET value = NULL WHERE key = 'modo_url'")
-    conn.commit()
-    conn.close()
+    await db.set_setting('modo_url', None)
     await query.edit_message_text("❌ Ссылка на MODO удалена.")
 
+@admin_required(MAIN_ADMIN)
 async def activate_modo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE settings SET value = 'true' WHERE key = 'modo_active'")
-    conn.commit()
-    conn.close()
+    await db.set_setting('modo_active', 'true')
+    await db.set_setting('modo_activated_at', str(int(time.time())))
     await query.edit_message_text("✅ MODO активирован.")
 
+@admin_required(MAIN_ADMIN)
 async def deactivate_modo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE settings SET value = 'false' WHERE key = 'modo_active'")
-    conn.commit()
-    conn.close()
+    await db.set_setting('modo_active', 'false')
     await query.edit_message_text("🚫 MODO деактивирован.")
 
 # Меню школьника
 async def student_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    modo_active = cursor.execute("SELECT value FROM settings WHERE key = 'modo_active'").fetchone()[0] == 'true'
-    conn.close()
+    modo_active = await db.get_setting('modo_active') == 'true'
     keyboard = []
     if modo_active:
         keyboard.append([InlineKeyboardButton("📚 Задания MODO", callback_data="modo_tasks")])
@@ -431,10 +723,7 @@ async def student_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def modo_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    modo_url = cursor.execute("SELECT value FROM settings WHERE key = 'modo_url'").fetchone()[0]
-    conn.close()
+    modo_url = await db.get_setting('modo_url')
     keyboard = []
     if modo_url:
         keyboard.append([InlineKeyboardButton("🔗 Перейти к заданиям", url=modo_url)])
@@ -447,16 +736,16 @@ async def my_screenshots(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    conn = sqlite3.connect('school_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT file_path, timestamp FROM screenshots WHERE user_id = ?", (user_id,))
-    screenshots = cursor.fetchall()
-    conn.close()
+    backward, key = parse_page(query.data.split("_")[1]) if query.data.startswith("myshots_") else (False, 0)
+    screenshots, has_prev, has_next = await db.get_my_screenshots(user_id, key, backward, MY_SCREENSHOTS_PAGE_SIZE)
+    if not screenshots and key:
+        screenshots, has_prev, has_next = await db.get_my_screenshots(user_id, page_size=MY_SCREENSHOTS_PAGE_SIZE)
     if not screenshots:
         await query.edit_message_text("📂 У вас нет скриншотов.")
         return
-    response = "📂 Ваши скриншоты:\n" + "\n".join([f"🕒 {ts}: {fp}" for fp, ts in screenshots])
-    await query.edit_message_text(response)
+    response = "📂 Ваши скриншоты:\n" + "\n".join([f"🕒 {ts}: {fp}" for _, fp, ts in screenshots])
+    nav = page_buttons("myshots", screenshots, has_prev, has_next)
+    await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup([nav]) if nav else None)
 
 async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -464,12 +753,74 @@ async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.message.delete()
     await student_menu(update, context)
 
+# Сводка задержек для админа
+def format_stats(title: str, rows: list) -> list:
+    lines = [title]
+    for name, count, mean, p50, p99 in rows:
+        lines.append(f"• {name}: {count} шт., ср. {mean * 1000:.0f} мс, p50 {p50 * 1000:.0f} мс, p99 {p99 * 1000:.0f} мс")
+    return lines
+
+@admin_required(MAIN_ADMIN)
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    errors = metrics.HANDLER_ERRORS.values()
+    in_flight = sum(metrics.HANDLER_IN_FLIGHT.values().values())
+    lines = [f"📊 Сейчас выполняется обработчиков: {in_flight:.0f}",
+             f"⚠️ Ошибок в обработчиках: {sum(errors.values()):.0f}", ""]
+    lines += format_stats("⏱ Обработчики:", metrics.summary(metrics.HANDLER_SECONDS, "handler")) + [""]
+    lines += format_stats("🗄 Запросы к базе:", metrics.summary(metrics.DB_SECONDS, "query")) + [""]
+    lines += format_stats("💾 Файлы и архивы:", metrics.summary(metrics.IO_SECONDS, "op")) + [""]
+    lines += format_stats("📡 Bot API:", metrics.summary(metrics.API_SECONDS, "method"))
+    await update.message.reply_text("\n".join(lines)[:4096])
+
+async def startup(application):
+    await access.refresh()
+    await search.refresh()
+    await ingest.start(application)
+    # рассылки и обслуживание ведёт один процесс, даже если их несколько
+    if cluster.is_primary():
+        await broadcast.resume(application)
+        await jobs.start(application, TEMP_ZIP_DIR, archive_cache)
+    await cluster.start()
+    application.bot_data['loop_lag_task'] = asyncio.get_running_loop().create_task(metrics.monitor_loop_lag())
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+# Фоновые задачи, которым нужен клиент Bot API, останавливаются до его закрытия
+async def on_stop(application):
+    await broadcast.stop()
+    await ingest.stop()
+
+async def shutdown(application):
+    server = application.bot_data.pop('metrics_server', None)
+    if server:
+        server.close()
+    lag_task = application.bot_data.pop('loop_lag_task', None)
+    if lag_task:
+        lag_task.cancel()
+    await cluster.stop()
+    images.shutdown()
+    packs.close()
+    db.close()
+
 # Главная функция
 def main():
 
-    application = ApplicationBuilder().token(TOKEN).build()
+    builder = (
+        ApplicationBuilder().token(TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest())
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(DbPersistence())
+        .post_init(startup)
+        .post_stop(on_stop)
+        .post_shutdown(shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    application = builder.build()
 
     registration_handler = ConversationHandler(
+        name="registration", persistent=True,
         entry_points=[CommandHandler("start", start)],
         states={
             GET_FIRST_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_first_name)],
@@ -480,12 +831,14 @@ def main():
     )
 
     admin_class_handler = ConversationHandler(
+        name="add_class", persistent=True,
         entry_points=[CallbackQueryHandler(admin_add_class, pattern='^add_class$')],
         states={ADD_CLASS: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_new_class)]},
         fallbacks=[]
     )
 
     admin_admin_handler = ConversationHandler(
+        name="add_admin", persistent=True,
         entry_points=[CallbackQueryHandler(admin_add_admin, pattern='^add_admin$')],
         states={
             ADD_ADMIN_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_admin_id)],
@@ -495,12 +848,14 @@ def main():
     )
 
     screenshot_handler = ConversationHandler(
+        name="upload_screenshot", persistent=True,
         entry_points=[CallbackQueryHandler(upload_screenshot, pattern='^upload_screenshot$')],
         states={UPLOAD_SCREENSHOT: [MessageHandler(filters.PHOTO, save_screenshot)]},
         fallbacks=[]
     )
 
     modo_url_handler = ConversationHandler(
+        name="modo_url", persistent=True,
         entry_points=[CallbackQueryHandler(set_modo_url_start, pattern='^set_modo_url$')],
         states={SET_MODO_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_modo_url_save)]},
         fallbacks=[]
@@ -508,28 +863,53 @@ def main():
 
     application.add_handler(registration_handler)
     application.add_handler(CommandHandler("sqlallget", sql_all_get))
+    application.add_handler(CommandHandler("duplicates", duplicates_report))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("find", find_student))
+    application.add_handler(CommandHandler("report", report_command))
+    application.add_handler(CommandHandler("missing", not_submitted))
+    application.add_handler(CommandHandler("completion", class_completion))
     application.add_handler(admin_class_handler)
     application.add_handler(admin_admin_handler)
     application.add_handler(CallbackQueryHandler(manage_admins, pattern='^manage_admins$'))
     application.add_handler(CallbackQueryHandler(back_to_main, pattern='^back_to_main$'))
-    application.add_handler(CallbackQueryHandler(show_class_students, pattern='^class_'))
-    application.add_handler(CallbackQueryHandler(show_student_profile, pattern='^student_'))
+    application.add_handler(CallbackQueryHandler(show_class_students, pattern='^(class|roster)_'))
+    application.add_handler(CallbackQueryHandler(show_student_profile, pattern='^(student|shots)_'))
     application.add_handler(CallbackQueryHandler(view_screenshot, pattern='^view_screenshot_'))
+    application.add_handler(CallbackQueryHandler(show_student_album, pattern='^album_'))
+    application.add_handler(CallbackQueryHandler(class_contact_sheet, pattern='^sheet_'))
     application.add_handler(CallbackQueryHandler(download_student, pattern='^download_student_'))
     application.add_handler(CallbackQueryHandler(download_class, pattern='^download_class_'))
     application.add_handler(CallbackQueryHandler(download_all_photos, pattern='^download_all_photos$'))
+    application.add_handler(CallbackQueryHandler(class_report, pattern='^report_'))
     application.add_handler(CommandHandler("menu", student_menu))
     application.add_handler(CallbackQueryHandler(modo_tasks, pattern='^modo_tasks$'))
-    application.add_handler(CallbackQueryHandler(my_screenshots, pattern='^my_screenshots$'))
+    application.add_handler(CallbackQueryHandler(my_screenshots, pattern='^(my_screenshots|myshots_[np]\\d+)$'))
     application.add_handler(CallbackQueryHandler(back_to_menu, pattern='^back_to_menu$'))
     application.add_handler(screenshot_handler)
     application.add_handler(CallbackQueryHandler(modo_settings, pattern='^modo_settings$'))
     application.add_handler(CallbackQueryHandler(remove_modo_url, pattern='^remove_modo_url$'))
     application.add_handler(CallbackQueryHandler(activate_modo, pattern='^activate_modo$'))
     application.add_handler(CallbackQueryHandler(deactivate_modo, pattern='^deactivate_modo$'))
+    application.add_handler(CallbackQueryHandler(broadcast_pick_class, pattern='^broadcast_pick$'))
+    application.add_handler(CallbackQueryHandler(start_broadcast, pattern='^broadcast_(all$|class_)'))
     application.add_handler(modo_url_handler)
+    instrument_application(application)
+
+    if cluster.is_front():
+        cluster.run_front(application.bot, start_updater, METRICS_PORT)
+    elif cluster.WORKER_INDEX is not None:
+        cluster.run_worker(application)
+    elif BOT_MODE == "webhook":
+        application.run_webhook(**WEBHOOK)
+    else:
+        application.run_polling()
 
-    application.run_polling()
+# Приём обновлений главным процессом в многопроцессном режиме
+def start_updater(updater):
+    if BOT_MODE == "webhook":
+        return updater.start_webhook(**WEBHOOK)
+    return updater.start_polling()
 
 if __name__ == '__main__':
     main()
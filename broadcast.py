@@ -0,0 +1,196 @@
+import sys
+import asyncio
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import db
+import cluster
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и не чаще
+# одного сообщения в секунду в один чат. Берём с запасом
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1.0
+SEND_WORKERS = 25
+MAX_ATTEMPTS = 5
+REPORT_INTERVAL = 5
+# Как часто первый рабочий процесс ищет рассылки, созданные в других процессах
+POLL_INTERVAL = 1
+
+
+# Ведро токенов: не больше rate отправок в секунду с допустимым всплеском capacity.
+# pause() останавливает выдачу целиком, когда Telegram ответил RetryAfter
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = None
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if self._updated is not None:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+_chat_last_sent = {}
+_running = set()
+_tasks = set()
+_watcher = None
+
+
+async def _wait_for_chat(chat_id: int):
+    loop = asyncio.get_running_loop()
+    delay = _chat_last_sent.get(chat_id, 0.0) + PER_CHAT_INTERVAL - loop.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    _chat_last_sent[chat_id] = loop.time()
+    if len(_chat_last_sent) > 10000:
+        cutoff = loop.time() - PER_CHAT_INTERVAL
+        for key in [key for key, sent in _chat_last_sent.items() if sent < cutoff]:
+            del _chat_last_sent[key]
+
+
+# Одна отправка с повторами: RetryAfter приостанавливает всю рассылку,
+# сетевые ошибки повторяются с нарастающей паузой
+async def _send(bot, chat_id: int, text: str) -> str:
+    for attempt in range(MAX_ATTEMPTS):
+        await _bucket.acquire()
+        await _wait_for_chat(chat_id)
+        try:
+            await bot.send_message(chat_id, text)
+            return "sent"
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            _bucket.pause(retry_after)
+        except (Forbidden, BadRequest):
+            return "failed"
+        except (TimedOut, NetworkError):
+            await asyncio.sleep(2 ** attempt)
+    return "failed"
+
+
+def _report_text(broadcast_id: int, counts: dict, done: bool) -> str:
+    sent, failed, pending = counts.get("sent", 0), counts.get("failed", 0), counts.get("pending", 0)
+    header = "✅ Рассылка завершена" if done else "📣 Рассылка идёт"
+    return f"{header} (#{broadcast_id})\n📬 Доставлено: {sent}\n⚠️ Ошибок: {failed}\n⏳ Осталось: {pending}"
+
+
+async def _report(bot, broadcast: tuple, done: bool = False):
+    broadcast_id, _, _, admin_chat_id, status_message_id = broadcast
+    counts = await db.get_broadcast_counts(broadcast_id)
+    try:
+        await bot.edit_message_text(_report_text(broadcast_id, counts, done), admin_chat_id, status_message_id)
+    except BadRequest:
+        pass
+
+
+# Выполнение рассылки: отправляет только ещё не обработанным получателям,
+# поэтому после перезапуска продолжает с того же места
+async def run(bot, broadcast_id: int):
+    if broadcast_id in _running:
+        return
+    _running.add(broadcast_id)
+    try:
+        broadcast = await db.get_broadcast(broadcast_id)
+        text = broadcast[1]
+        recipients = asyncio.Queue()
+        for user_id in await db.get_pending_recipients(broadcast_id):
+            recipients.put_nowait(user_id)
+
+        async def worker():
+            while not recipients.empty():
+                user_id = recipients.get_nowait()
+                status = await _send(bot, user_id, text)
+                await db.set_recipient_status(broadcast_id, user_id, status)
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(REPORT_INTERVAL)
+                await _report(bot, broadcast)
+
+        progress = asyncio.ensure_future(reporter())
+        try:
+            await asyncio.gather(*[worker() for _ in range(SEND_WORKERS)])
+        finally:
+            progress.cancel()
+        await db.finish_broadcast(broadcast_id)
+        await _report(bot, broadcast, done=True)
+    finally:
+        _running.discard(broadcast_id)
+
+
+def _done(task: asyncio.Task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"⚠️ Рассылка прервана с ошибкой: {task.exception()!r}", file=sys.stderr)
+
+
+# Рассылка идёт отдельной задачей цикла, а не application.create_task: Application.stop()
+# ждёт свои задачи, и остановка бота затянулась бы до конца рассылки
+def _launch(bot, broadcast_id: int):
+    task = asyncio.get_running_loop().create_task(run(bot, broadcast_id))
+    _tasks.add(task)
+    task.add_done_callback(_done)
+
+
+# Лимиты общие для бота, поэтому в многопроцессном режиме рассылки ведёт только
+# первый рабочий процесс: остальные лишь создают строку, он подхватывает её из базы
+async def start(application, text: str, class_name: str, admin_chat_id: int, status_message_id: int) -> int:
+    broadcast_id = await db.create_broadcast(text, class_name, admin_chat_id, status_message_id)
+    if cluster.is_primary():
+        _launch(application.bot, broadcast_id)
+    return broadcast_id
+
+
+async def _resume_active(application):
+    for broadcast_id in await db.get_active_broadcasts():
+        if broadcast_id not in _running:
+            _launch(application.bot, broadcast_id)
+
+
+async def _watch(application):
+    while True:
+        await asyncio.sleep(POLL_INTERVAL)
+        try:
+            await _resume_active(application)
+        except Exception:
+            # повторим при следующей проверке
+            pass
+
+
+# Возобновление незавершённых рассылок при старте бота; в многопроцессном
+# режиме первый рабочий процесс дальше следит за новыми рассылками
+async def resume(application):
+    global _watcher
+    await _resume_active(application)
+    if cluster.WORKERS > 1:
+        _watcher = asyncio.get_running_loop().create_task(_watch(application))
+
+
+# Остановка до закрытия клиента Bot API (post_stop): прерванные рассылки
+# продолжатся при следующем запуске по статусам получателей в базе
+async def stop():
+    global _watcher
+    tasks = list(_tasks)
+    if _watcher:
+        tasks.append(_watcher)
+        _watcher = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import signal
+import asyncio
+
+from telegram import Update
+from telegram.ext import Updater
+
+import db
+import access
+import search
+from updates import update_key
+
+# Многопроцессный режим (BOT_WORKERS > 1): главный процесс получает обновления
+# (polling или webhook) и раздаёт их рабочим процессам по user_id, поэтому
+# диалоги одного пользователя всегда обрабатывает один и тот же процесс.
+# Рабочие процессы — тот же bot.py с BOT_WORKER_INDEX; они делят базу (WAL),
+# photos/ и хранилище диалогов, а изменения кешей узнают по версиям в базе
+WORKERS = int(os.environ.get("BOT_WORKERS", "1"))
+WORKER_INDEX = int(os.environ["BOT_WORKER_INDEX"]) if os.environ.get("BOT_WORKER_INDEX") else None
+SOCKET_DIR = os.environ.get("BOT_SOCKET_DIR", "run")
+CONNECT_TIMEOUT = 60
+CACHE_POLL_INTERVAL = 0.25
+# Одно обновление — одна строка JSON; запас на длинные сообщения
+LINE_LIMIT = 4 * 1024 * 1024
+
+_tasks = []
+
+
+def is_front() -> bool:
+    return WORKERS > 1 and WORKER_INDEX is None
+
+
+# Обычный запуск или первый рабочий процесс: только он ведёт рассылки и периодические задачи
+def is_primary() -> bool:
+    return WORKER_INDEX in (None, 0)
+
+
+def shard(key: int) -> int:
+    return key % WORKERS
+
+
+# Загрузки пользователя ведёт тот процесс, который получает его обновления
+def owns(user_id: int) -> bool:
+    return WORKER_INDEX is None or shard(user_id) == WORKER_INDEX
+
+
+def socket_path(index: int) -> str:
+    return os.path.join(SOCKET_DIR, f"worker{index}.sock")
+
+
+def _stop_on_signals(stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+
+# Главный процесс
+
+class _Worker:
+    def __init__(self, index: int, env: dict):
+        self.index = index
+        self.env = env
+        self.process = None
+        self.writer = None
+
+    async def spawn(self):
+        self.process = await asyncio.create_subprocess_exec(sys.executable, *sys.argv, env=self.env)
+
+    async def connect(self):
+        for _ in range(CONNECT_TIMEOUT * 10):
+            if self.process.returncode is not None:
+                break
+            try:
+                _, self.writer = await asyncio.open_unix_connection(socket_path(self.index))
+                return
+            except OSError:
+                await asyncio.sleep(0.1)
+        raise RuntimeError(f"Рабочий процесс {self.index} не запустился")
+
+    async def send(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def stop(self):
+        if self.writer:
+            self.writer.close()
+        if self.process.returncode is None:
+            self.process.terminate()
+        await self.process.wait()
+
+
+def _worker_env(index: int, metrics_port: int) -> dict:
+    env = dict(os.environ, BOT_WORKER_INDEX=str(index))
+    # у каждого рабочего процесса своя точка метрик: METRICS_PORT + 1 + номер
+    env["METRICS_PORT"] = str(metrics_port + 1 + index if metrics_port else 0)
+    # ядра делятся между процессами бота, а не отдаются пулу картинок каждого
+    env.setdefault("IMAGE_WORKERS", str(max(1, (os.cpu_count() or 2) // WORKERS)))
+    return env
+
+
+async def _dispatch(queue: asyncio.Queue, workers: list):
+    while True:
+        update = await queue.get()
+        key = update_key(update)
+        worker = workers[shard(key) if key is not None else 0]
+        await worker.send(json.dumps(update.to_dict(), ensure_ascii=False).encode() + b"\n")
+
+
+# Рабочий процесс, завершившийся сам, останавливает весь бот: перезапуском
+# занимается внешний менеджер (systemd и т. п.), шарды не теряются молча
+async def _watch(workers: list, stop: asyncio.Event):
+    await asyncio.wait([asyncio.ensure_future(worker.process.wait()) for worker in workers],
+                       return_when=asyncio.FIRST_COMPLETED)
+    if not stop.is_set():
+        print("⚠️ Рабочий процесс завершился, бот останавливается", file=sys.stderr)
+        stop.set()
+
+
+async def _front(bot, start_updater, metrics_port: int):
+    os.makedirs(SOCKET_DIR, exist_ok=True)
+    workers = [_Worker(index, _worker_env(index, metrics_port)) for index in range(WORKERS)]
+    for worker in workers:
+        await worker.spawn()
+    stop = asyncio.Event()
+    _stop_on_signals(stop)
+    try:
+        for worker in workers:
+            await worker.connect()
+        queue = asyncio.Queue()
+        async with Updater(bot, queue) as updater:
+            await start_updater(updater)
+            dispatcher = asyncio.ensure_future(_dispatch(queue, workers))
+            watcher = asyncio.ensure_future(_watch(workers, stop))
+            await asyncio.wait([dispatcher, asyncio.ensure_future(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+            await updater.stop()
+            # полученные, но не разосланные обновления дописываются рабочим процессам
+            while not queue.empty() and not dispatcher.done():
+                await asyncio.sleep(0.05)
+            if dispatcher.done() and dispatcher.exception():
+                print(f"⚠️ Обновления не доставлены рабочему процессу: {dispatcher.exception()!r}", file=sys.stderr)
+            dispatcher.cancel()
+            watcher.cancel()
+    finally:
+        stop.set()
+        for worker in workers:
+            await worker.stop()
+
+
+def run_front(bot, start_updater, metrics_port: int):
+    asyncio.run(_front(bot, start_updater, metrics_port))
+
+
+# Рабочий процесс
+
+async def _receive(application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while line := await reader.readline():
+            await application.update_queue.put(Update.de_json(json.loads(line), application.bot))
+    finally:
+        writer.close()
+
+
+async def _worker(application):
+    path = socket_path(WORKER_INDEX)
+    if os.path.exists(path):
+        os.remove(path)
+    stop = asyncio.Event()
+    _stop_on_signals(stop)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    server = await asyncio.start_unix_server(lambda reader, writer: _receive(application, reader, writer),
+                                             path, limit=LINE_LIMIT)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_worker(application):
+    asyncio.run(_worker(application))
+
+
+# Кеши процесса (настройки, классы, права админов, поисковый индекс) сверяются
+# с версиями в базе и перезагружаются, когда их изменил другой процесс
+async def _watch_caches():
+    while True:
+        await asyncio.sleep(CACHE_POLL_INTERVAL)
+        try:
+            changed = await db.changed_caches()
+            if changed & {"settings", "classes"}:
+                await db.reload_cache()
+            if "admins" in changed:
+                await access.refresh()
+            if "students" in changed:
+                await search.update()
+        except Exception:
+            # повторим при следующей проверке
+            pass
+
+
+async def start():
+    if WORKER_INDEX is not None:
+        _tasks.append(asyncio.get_running_loop().create_task(_watch_caches()))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
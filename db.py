@@ -0,0 +1,980 @@
+import queue
+import sqlite3
+import asyncio
+import threading
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Путь к базе и параметры пула
+DB_PATH = 'school_bot.db'
+READ_WORKERS = 4
+WRITE_BATCH_SIZE = 256
+
+# Строковые отметки времени скриншотов — местное время Алматы
+TIMEZONE = ZoneInfo("Asia/Almaty")
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+# Общие запросы: sqlite3 кеширует подготовленные выражения на соединении,
+# поэтому все обработчики используют одни и те же строки SQL
+SQL_STUDENT_BY_USER = "SELECT * FROM students WHERE user_id = ?"
+SQL_STUDENT_BY_ID = "SELECT first_name, last_name, class, username, user_id FROM students WHERE id = ?"
+SQL_STUDENT_CLASS = "SELECT class FROM students WHERE user_id = ?"
+SQL_INSERT_STUDENT = ("INSERT OR IGNORE INTO students (user_id, first_name, last_name, class, username) "
+                      "VALUES (?, ?, ?, ?, ?)")
+SQL_SEARCH_STUDENTS = "SELECT id, first_name, last_name, username, class FROM students WHERE id > ?"
+SQL_CLASSES = "SELECT name FROM classes"
+SQL_INSERT_CLASS = "INSERT INTO classes (name) VALUES (?)"
+SQL_UPSERT_ADMIN = "INSERT OR REPLACE INTO admins (user_id, class_access) VALUES (?, ?)"
+SQL_ADMINS = "SELECT user_id, class_access FROM admins"
+# Постраничные выборки по ключу: первая колонка — id, по которому листаем
+SQL_CLASS_ROSTER = """
+    SELECT s.id, s.first_name, s.last_name, st.last_upload, COALESCE(st.screenshot_count, 0)
+    FROM students s LEFT JOIN student_stats st ON st.user_id = s.user_id
+    WHERE s.class = ?
+"""
+SQL_CLASS_ROSTER_AFTER = SQL_CLASS_ROSTER + " AND s.id > ? ORDER BY s.id LIMIT ?"
+SQL_CLASS_ROSTER_BEFORE = SQL_CLASS_ROSTER + " AND s.id < ? ORDER BY s.id DESC LIMIT ?"
+# Строки с путём к файлу дополняются его местом в пак-файле (pack_path, offset, size), если он упакован
+SQL_CLASS_LATEST_SCREENSHOTS = """
+    SELECT t.first_name, t.last_name, t.file_path, pe.pack_path, pe.offset, pe.size
+    FROM (SELECT s.first_name, s.last_name,
+                 (SELECT file_path FROM screenshots WHERE user_id = s.user_id ORDER BY timestamp DESC LIMIT 1) AS file_path
+          FROM students s WHERE s.class = ?) t
+    LEFT JOIN pack_entries pe ON pe.file_path = t.file_path
+    ORDER BY t.last_name, t.first_name
+"""
+SQL_STUDENT_SCREENSHOTS_AFTER = "SELECT id, timestamp FROM screenshots WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?"
+SQL_STUDENT_SCREENSHOTS_BEFORE = ("SELECT id, timestamp FROM screenshots WHERE user_id = ? AND id < ? "
+                                  "ORDER BY id DESC LIMIT ?")
+# Выборки по ученику начинаются с его класса: по нему проверяется доступ админа без отдельного запроса
+SQL_STUDENT_MANIFEST = """
+    SELECT s.class, sc.id, sc.file_path, pe.pack_path, pe.offset, pe.size
+    FROM screenshots sc LEFT JOIN students s ON s.user_id = sc.user_id
+    LEFT JOIN pack_entries pe ON pe.file_path = sc.file_path
+    WHERE sc.user_id = ? ORDER BY sc.id
+"""
+SQL_CLASS_MANIFEST = """
+    SELECT sc.id, sc.file_path, pe.pack_path, pe.offset, pe.size
+    FROM screenshots sc JOIN students s ON s.user_id = sc.user_id
+    LEFT JOIN pack_entries pe ON pe.file_path = sc.file_path
+    WHERE s.class = ? ORDER BY sc.id
+"""
+SQL_ALL_MANIFEST = """
+    SELECT sc.id, sc.file_path, pe.pack_path, pe.offset, pe.size
+    FROM screenshots sc LEFT JOIN pack_entries pe ON pe.file_path = sc.file_path ORDER BY sc.id
+"""
+SQL_MY_SCREENSHOTS_AFTER = ("SELECT id, file_path, timestamp FROM screenshots WHERE user_id = ? AND id > ? "
+                            "ORDER BY id LIMIT ?")
+SQL_MY_SCREENSHOTS_BEFORE = ("SELECT id, file_path, timestamp FROM screenshots WHERE user_id = ? AND id < ? "
+                             "ORDER BY id DESC LIMIT ?")
+SQL_SCREENSHOT = """
+    SELECT sc.file_path, sc.file_id, s.class, pe.pack_path, pe.offset, pe.size
+    FROM screenshots sc LEFT JOIN students s ON s.user_id = sc.user_id
+    LEFT JOIN pack_entries pe ON pe.file_path = sc.file_path WHERE sc.id = ?
+"""
+SQL_STUDENT_PHOTOS = """
+    SELECT s.class, sc.id, sc.file_path, sc.file_id, sc.timestamp, pe.pack_path, pe.offset, pe.size
+    FROM screenshots sc LEFT JOIN students s ON s.user_id = sc.user_id
+    LEFT JOIN pack_entries pe ON pe.file_path = sc.file_path
+    WHERE sc.user_id = ? ORDER BY sc.id
+"""
+SQL_INSERT_SCREENSHOT = ("INSERT INTO screenshots (user_id, file_path, timestamp, file_id, file_unique_id, "
+                         "content_hash, phash, uploaded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+SQL_SET_SCREENSHOT_FILE_ID = "UPDATE screenshots SET file_id = ? WHERE id = ?"
+# Поиск дублей: сначала совпадение у того же ученика, затем у любого другого
+SQL_SCREENSHOT_BY_UNIQUE_ID = ("SELECT id, user_id, file_path, content_hash, phash FROM screenshots "
+                               "WHERE file_unique_id = ? ORDER BY user_id = ? DESC, id LIMIT 1")
+SQL_SCREENSHOT_BY_HASH = ("SELECT id, user_id, file_path FROM screenshots "
+                          "WHERE content_hash = ? ORDER BY user_id = ? DESC, id LIMIT 1")
+SQL_SCREENSHOT_PATH_USED = "SELECT 1 FROM screenshots WHERE file_path = ? LIMIT 1"
+SQL_UNHASHED_SCREENSHOTS = """
+    SELECT sc.id, sc.user_id, sc.file_path, pe.pack_path, pe.offset, pe.size
+    FROM screenshots sc LEFT JOIN pack_entries pe ON pe.file_path = sc.file_path
+    WHERE sc.content_hash IS NULL ORDER BY sc.id
+"""
+SQL_SET_SCREENSHOT_HASHES = "UPDATE screenshots SET content_hash = ?, phash = ? WHERE id = ?"
+SQL_LINK_SCREENSHOT = "UPDATE screenshots SET file_path = ?, content_hash = ?, phash = ? WHERE id = ?"
+SQL_DELETE_SCREENSHOT = "DELETE FROM screenshots WHERE id = ?"
+SQL_PHASHES = """
+    SELECT sc.id, sc.user_id, s.class, sc.phash, sc.timestamp
+    FROM screenshots sc JOIN students s ON s.user_id = sc.user_id
+    WHERE sc.phash IS NOT NULL ORDER BY s.class, sc.id
+"""
+SQL_STUDENT_NAMES = "SELECT user_id, first_name, last_name FROM students"
+SQL_DELETE_STUDENT_STATS = "DELETE FROM student_stats WHERE user_id = ?"
+SQL_REFRESH_STUDENT_STATS = """
+    INSERT INTO student_stats (user_id, screenshot_count, last_upload)
+    SELECT user_id, COUNT(*), MAX(timestamp) FROM screenshots WHERE user_id = ? GROUP BY user_id
+"""
+SQL_BUMP_STUDENT_STATS = """
+    INSERT INTO student_stats (user_id, screenshot_count, last_upload) VALUES (?, 1, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        screenshot_count = screenshot_count + 1,
+        last_upload = MAX(COALESCE(last_upload, ''), excluded.last_upload)
+"""
+# Отчёт о сдаче: одна строка на ученика, включая тех, кто ничего не прислал
+SQL_SUBMISSION_REPORT = """
+    SELECT s.class, s.last_name, s.first_name, s.username, COUNT(sc.id), MIN(sc.timestamp), MAX(sc.timestamp)
+    FROM students s LEFT JOIN screenshots sc ON sc.user_id = s.user_id
+    WHERE ?1 IS NULL OR s.class = ?1
+    GROUP BY s.id ORDER BY s.class, s.last_name, s.first_name
+"""
+# Сводка по дням: счётчики ведутся при вставке скриншота
+SQL_UPLOADED_SAME_DAY = ("SELECT 1 FROM screenshots WHERE user_id = ? AND uploaded_at >= ? AND uploaded_at < ? "
+                         "AND id != ? LIMIT 1")
+SQL_BUMP_CLASS_DAY = """
+    INSERT INTO class_daily_uploads (class, day, uploads, students) VALUES (?, ?, 1, ?)
+    ON CONFLICT(class, day) DO UPDATE SET uploads = uploads + 1, students = students + excluded.students
+"""
+SQL_CLEAR_CLASS_DAYS = "DELETE FROM class_daily_uploads"
+SQL_REBUILD_CLASS_DAYS = """
+    INSERT INTO class_daily_uploads (class, day, uploads, students)
+    SELECT s.class, substr(sc.timestamp, 1, 10), COUNT(*), COUNT(DISTINCT sc.user_id)
+    FROM screenshots sc JOIN students s ON s.user_id = sc.user_id
+    WHERE sc.timestamp IS NOT NULL GROUP BY s.class, substr(sc.timestamp, 1, 10)
+"""
+# Кто не присылал скриншотов с момента since: проверка по индексу (user_id, uploaded_at)
+SQL_NOT_SUBMITTED = """
+    SELECT s.id, s.first_name, s.last_name, s.class, st.last_upload
+    FROM students s LEFT JOIN student_stats st ON st.user_id = s.user_id
+    WHERE (?1 IS NULL OR s.class = ?1) AND NOT EXISTS (
+        SELECT 1 FROM screenshots sc WHERE sc.user_id = s.user_id AND sc.uploaded_at >= ?2)
+    ORDER BY s.class, s.last_name, s.first_name
+"""
+SQL_CLASS_COMPLETION = """
+    SELECT s.class, COUNT(*), SUM(EXISTS (
+        SELECT 1 FROM screenshots sc WHERE sc.user_id = s.user_id AND sc.uploaded_at >= ?))
+    FROM students s GROUP BY s.class ORDER BY s.class
+"""
+SQL_CLASS_UPLOADS_SINCE = "SELECT class, SUM(uploads) FROM class_daily_uploads WHERE day >= ? GROUP BY class"
+# Упаковка старых файлов: по одному разу на файл, даже если на него ссылаются несколько строк
+SQL_PACK_CANDIDATES = """
+    SELECT sc.file_path, MIN(s.class), MIN(substr(sc.timestamp, 1, 7))
+    FROM screenshots sc JOIN students s ON s.user_id = sc.user_id
+    LEFT JOIN pack_entries pe ON pe.file_path = sc.file_path
+    WHERE sc.uploaded_at < ? AND pe.file_path IS NULL
+    GROUP BY sc.file_path ORDER BY 2, 3
+"""
+SQL_INSERT_PACK_ENTRY = "INSERT OR IGNORE INTO pack_entries (file_path, pack_path, offset, size) VALUES (?, ?, ?, ?)"
+SQL_DELETE_PACK_ENTRY = "DELETE FROM pack_entries WHERE file_path = ?"
+SQL_CLEAR_STUDENT_STATS = "DELETE FROM student_stats"
+SQL_REBUILD_STUDENT_STATS = """
+    INSERT INTO student_stats (user_id, screenshot_count, last_upload)
+    SELECT user_id, COUNT(*), MAX(timestamp) FROM screenshots GROUP BY user_id
+"""
+SQL_JOB_STATES = "SELECT name, last_run, next_run, last_error FROM scheduled_jobs"
+SQL_SAVE_JOB_STATE = """
+    INSERT INTO scheduled_jobs (name, last_run, next_run, last_error) VALUES (?, ?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET
+        last_run = COALESCE(excluded.last_run, last_run), next_run = excluded.next_run, last_error = excluded.last_error
+"""
+SQL_SETTINGS = "SELECT key, value FROM settings"
+SQL_CACHE_VERSIONS = "SELECT name, version FROM cache_versions"
+SQL_BUMP_CACHE_VERSION = "UPDATE cache_versions SET version = version + 1 WHERE name = ? RETURNING version"
+SQL_USER_DATA = "SELECT user_id, data FROM user_data"
+SQL_SAVE_USER_DATA = "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)"
+SQL_DROP_USER_DATA = "DELETE FROM user_data WHERE user_id = ?"
+SQL_CONVERSATIONS = "SELECT key, state FROM conversations WHERE name = ?"
+SQL_SAVE_CONVERSATION = "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)"
+SQL_DROP_CONVERSATION = "DELETE FROM conversations WHERE name = ? AND key = ?"
+SQL_INSERT_BROADCAST = ("INSERT INTO broadcasts (text, class, admin_chat_id, status_message_id, created_at) "
+                        "VALUES (?, ?, ?, ?, strftime('%s', 'now'))")
+SQL_ADD_RECIPIENTS_ALL = ("INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) "
+                          "SELECT ?, user_id FROM students")
+SQL_ADD_RECIPIENTS_CLASS = ("INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) "
+                            "SELECT ?, user_id FROM students WHERE class = ?")
+SQL_BROADCAST = "SELECT id, text, class, admin_chat_id, status_message_id FROM broadcasts WHERE id = ?"
+SQL_ACTIVE_BROADCASTS = "SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id"
+SQL_PENDING_RECIPIENTS = ("SELECT user_id FROM broadcast_recipients "
+                          "WHERE broadcast_id = ? AND status = 'pending' ORDER BY user_id")
+SQL_SET_RECIPIENT_STATUS = "UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND user_id = ?"
+SQL_BROADCAST_COUNTS = "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status"
+SQL_FINISH_BROADCAST = "UPDATE broadcasts SET status = 'done' WHERE id = ?"
+SQL_SET_SETTING = "UPDATE settings SET value = ? WHERE key = ?"
+SQL_INSERT_PENDING_UPLOAD = ("INSERT OR IGNORE INTO pending_uploads (user_id, chat_id, file_id, file_unique_id, "
+                             "file_path, timestamp, created_at) VALUES (?, ?, ?, ?, ?, ?, strftime('%s', 'now'))")
+SQL_PENDING_UPLOAD = ("SELECT id, user_id, chat_id, file_id, file_unique_id, file_path, timestamp, attempts "
+                      "FROM pending_uploads WHERE id = ?")
+SQL_PENDING_UPLOADS = ("SELECT id, user_id, chat_id, file_id, file_unique_id, file_path, timestamp, attempts "
+                       "FROM pending_uploads ORDER BY id")
+SQL_BUMP_UPLOAD_ATTEMPTS = "UPDATE pending_uploads SET attempts = attempts + 1 WHERE id = ?"
+SQL_DELETE_PENDING_UPLOAD = "DELETE FROM pending_uploads WHERE id = ?"
+
+
+def connect(path: str = None, readonly: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(path or DB_PATH, isolation_level=None, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+# Инициализация базы данных
+def init_db():
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS students (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER UNIQUE,
+        first_name TEXT,
+        last_name TEXT,
+        class TEXT,
+        username TEXT)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS classes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS admins (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER UNIQUE,
+        username TEXT,
+        class_access TEXT)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS screenshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        file_path TEXT,
+        timestamp TEXT)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT)''')
+    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('modo_url', 'https://class-kz.ru/ucheniku/modo-4-klass/')")
+    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('modo_active', 'true')")
+    migrate(conn)
+    # версии читаются раньше данных: изменение между ними вызовет лишнюю, но не пропущенную перезагрузку
+    _load_cache_versions(conn)
+    _load_cache(conn)
+    conn.close()
+
+
+def to_epoch(timestamp: str):
+    try:
+        return int(datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=TIMEZONE).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+# Начало местных суток day ('ГГГГ-ММ-ДД') в секундах UTC
+def day_start(day: str) -> int:
+    return int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=TIMEZONE).timestamp())
+
+
+# Миграции схемы: номер применённой хранится в PRAGMA user_version
+def _migration_roster_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_user ON screenshots (user_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_students_class ON students (class)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS student_stats (
+        user_id INTEGER PRIMARY KEY,
+        screenshot_count INTEGER NOT NULL DEFAULT 0,
+        last_upload TEXT)''')
+    conn.execute("""
+        INSERT OR REPLACE INTO student_stats (user_id, screenshot_count, last_upload)
+        SELECT user_id, COUNT(*), MAX(timestamp) FROM screenshots GROUP BY user_id
+    """)
+
+
+def _migration_telegram_file_ids(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE screenshots ADD COLUMN file_id TEXT")
+    conn.execute("ALTER TABLE screenshots ADD COLUMN file_unique_id TEXT")
+
+
+def _migration_content_hashes(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE screenshots ADD COLUMN content_hash TEXT")
+    conn.execute("ALTER TABLE screenshots ADD COLUMN phash INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_unique_id ON screenshots (file_unique_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_hash ON screenshots (content_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_path ON screenshots (file_path)")
+
+
+def _migration_page_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_user_page ON screenshots (user_id, id)")
+
+
+def _migration_broadcasts(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        class TEXT,
+        admin_chat_id INTEGER,
+        status_message_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'pending',
+        PRIMARY KEY (broadcast_id, user_id)) WITHOUT ROWID''')
+
+
+# Очередь загрузок: скриншот записывается сюда до скачивания и удаляется
+# вместе с добавлением в screenshots, поэтому переживает перезапуск
+def _migration_pending_uploads(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS pending_uploads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        chat_id INTEGER,
+        file_id TEXT,
+        file_unique_id TEXT,
+        file_path TEXT,
+        timestamp TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER,
+        UNIQUE (user_id, file_unique_id))''')
+
+
+# Отметка времени числом (секунды UTC) для запросов по диапазону и сводка по классам и дням
+def _migration_epoch_timestamps(conn: sqlite3.Connection):
+    conn.create_function("to_epoch", 1, to_epoch, deterministic=True)
+    conn.execute("ALTER TABLE screenshots ADD COLUMN uploaded_at INTEGER")
+    conn.execute("UPDATE screenshots SET uploaded_at = to_epoch(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_uploaded ON screenshots (uploaded_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_user_uploaded ON screenshots (user_id, uploaded_at)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS class_daily_uploads (
+        class TEXT,
+        day TEXT,
+        uploads INTEGER NOT NULL DEFAULT 0,
+        students INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (class, day)) WITHOUT ROWID''')
+    conn.execute(SQL_REBUILD_CLASS_DAYS)
+    conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('modo_activated_at', NULL)")
+
+
+# Индекс пак-файлов: где внутри пака лежат байты упакованного файла
+def _migration_pack_entries(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS pack_entries (
+        file_path TEXT PRIMARY KEY,
+        pack_path TEXT NOT NULL,
+        offset INTEGER NOT NULL,
+        size INTEGER NOT NULL) WITHOUT ROWID''')
+
+
+# Состояние периодических задач: время следующего запуска переживает перезапуск
+def _migration_scheduled_jobs(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        name TEXT PRIMARY KEY,
+        last_run INTEGER,
+        next_run INTEGER,
+        last_error TEXT)''')
+
+
+# Общее состояние для нескольких процессов бота: версии кешей, по которым
+# процессы узнают об изменениях, и данные диалогов ConversationHandler
+def _migration_shared_state(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS cache_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''')
+    conn.executemany("INSERT OR IGNORE INTO cache_versions (name) VALUES (?)", [(name,) for name in CACHES])
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (name, key)) WITHOUT ROWID''')
+
+
+MIGRATIONS = [
+    _migration_roster_indexes,
+    _migration_telegram_file_ids,
+    _migration_content_hashes,
+    _migration_page_indexes,
+    _migration_broadcasts,
+    _migration_pending_uploads,
+    _migration_epoch_timestamps,
+    _migration_pack_entries,
+    _migration_scheduled_jobs,
+    _migration_shared_state,
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+# Поток записи: все изменения идут через одно соединение, а записи,
+# накопившиеся в очереди, фиксируются одной транзакцией
+class _Writer(threading.Thread):
+    def __init__(self, path: str):
+        super().__init__(name="db-writer", daemon=True)
+        self._path = path
+        self._queue = queue.Queue()
+
+    def submit(self, fn) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((fn, loop, future))
+        return future
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        conn = connect(self._path)
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [item for item in batch if item is not None]
+            # Операции вне транзакции (VACUUM) выполняются по одной, в порядке очереди
+            pending = []
+            for item in batch:
+                if isinstance(item[0], _Standalone):
+                    if pending:
+                        self._commit(conn, pending)
+                        pending = []
+                    self._run_standalone(conn, item)
+                else:
+                    pending.append(item)
+            if pending:
+                self._commit(conn, pending)
+        conn.close()
+
+    @staticmethod
+    def _run_standalone(conn: sqlite3.Connection, item: tuple):
+        standalone, loop, future = item
+        try:
+            result, error = standalone.fn(conn), None
+        except Exception as e:
+            result, error = None, e
+        loop.call_soon_threadsafe(_resolve, future, result, error)
+
+    @staticmethod
+    def _commit(conn: sqlite3.Connection, batch: list):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Каждая запись в своей точке сохранения: ошибка одной не откатывает остальные
+            for fn, _, _ in batch:
+                conn.execute("SAVEPOINT batch_item")
+                try:
+                    results.append((fn(conn), None))
+                    conn.execute("RELEASE batch_item")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO batch_item")
+                    conn.execute("RELEASE batch_item")
+                    results.append((None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(None, e)] * len(batch)
+        for (_, loop, future), (result, error) in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+
+
+class _Standalone:
+    def __init__(self, fn):
+        self.fn = fn
+
+
+def _resolve(future: asyncio.Future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+# Кеш настроек и списка классов: меняются редко, читаются на каждое нажатие.
+# Загружается при старте и обновляется только после успешной записи в базу
+_settings = {}
+_classes = []
+
+
+def _load_cache(conn: sqlite3.Connection):
+    global _settings, _classes
+    _settings = dict(conn.execute(SQL_SETTINGS).fetchall())
+    _classes = [row[0] for row in conn.execute(SQL_CLASSES).fetchall()]
+
+
+async def reload_cache():
+    await read(_load_cache, "reload_cache")
+
+
+# Версии кешей: запись, меняющая кешируемые данные, увеличивает версию в той же
+# транзакции, а другие процессы бота сравнивают версии и перезагружают свои копии
+CACHES = ("settings", "classes", "admins", "students")
+_cache_versions = {}
+
+
+def _load_cache_versions(conn: sqlite3.Connection):
+    _cache_versions.update(conn.execute(SQL_CACHE_VERSIONS).fetchall())
+
+
+def _bump_cache_version(conn: sqlite3.Connection, name: str) -> int:
+    return conn.execute(SQL_BUMP_CACHE_VERSION, (name,)).fetchone()[0]
+
+
+# Своё изменение уже применено к кешу; если чужих между версиями не было, перезагрузка не нужна
+def _applied(name: str, version: int):
+    if _cache_versions.get(name) == version - 1:
+        _cache_versions[name] = version
+
+
+# Имена кешей, изменённых другими процессами с прошлой проверки
+async def changed_caches() -> set:
+    changed = set()
+    for name, version in await fetchall(SQL_CACHE_VERSIONS):
+        if _cache_versions.get(name) != version:
+            _cache_versions[name] = version
+            changed.add(name)
+    return changed
+
+
+_local = threading.local()
+_readers = None
+_writer = None
+_lock = threading.Lock()
+
+
+def _reader_connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect(readonly=True)
+    return conn
+
+
+def _read_in_thread(fn):
+    return fn(_reader_connection())
+
+
+def _ensure_started():
+    global _readers, _writer
+    if _writer is not None:
+        return
+    with _lock:
+        if _writer is None:
+            _readers = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="db-reader")
+            writer = _Writer(DB_PATH)
+            writer.start()
+            _writer = writer
+
+
+def close():
+    global _readers, _writer
+    with _lock:
+        if _writer is not None:
+            _writer.stop()
+            _readers.shutdown(wait=True)
+            _readers = _writer = None
+
+
+# Имя запроса для метрик — имя константы SQL_*, иначе начало текста запроса
+_query_names = {}
+
+
+def _query_name(sql: str) -> str:
+    if not _query_names:
+        _query_names.update({value: name for name, value in globals().items()
+                             if name.startswith("SQL_") and isinstance(value, str)})
+    return _query_names.get(sql) or " ".join(sql.split()[:3])
+
+
+# Низкоуровневый доступ: чтение в пуле потоков, запись через поток записи
+async def read(fn, name: str = "read"):
+    _ensure_started()
+    with metrics.timer(metrics.DB_SECONDS, query=name):
+        return await asyncio.get_running_loop().run_in_executor(_readers, _read_in_thread, fn)
+
+
+async def write(fn, name: str = "write"):
+    _ensure_started()
+    with metrics.timer(metrics.DB_SECONDS, query=name):
+        return await _writer.submit(fn)
+
+
+# Запись вне транзакции на соединении потока записи: остальные записи ждут её в очереди
+async def write_standalone(fn, name: str = "write_standalone"):
+    _ensure_started()
+    with metrics.timer(metrics.DB_SECONDS, query=name):
+        return await _writer.submit(_Standalone(fn))
+
+
+async def fetchone(sql: str, params: tuple = ()):
+    return await read(lambda conn: conn.execute(sql, params).fetchone(), _query_name(sql))
+
+
+async def fetchall(sql: str, params: tuple = ()):
+    return await read(lambda conn: conn.execute(sql, params).fetchall(), _query_name(sql))
+
+
+async def execute(sql: str, params: tuple = ()) -> int:
+    return await write(lambda conn: conn.execute(sql, params).lastrowid, _query_name(sql))
+
+
+# Построчная обработка результата в потоке чтения: consume получает курсор,
+# поэтому большие выборки не собираются в память целиком
+async def stream(sql: str, params: tuple, consume):
+    return await read(lambda conn: consume(conn.execute(sql, params)), _query_name(sql))
+
+
+# Страница по ключу: строки после key (или перед ним при backward), без OFFSET.
+# Возвращает (строки, есть_предыдущая, есть_следующая)
+async def fetch_page(sql_after: str, sql_before: str, params: tuple, key: int, backward: bool, page_size: int):
+    if backward:
+        rows = await fetchall(sql_before, (*params, key, page_size + 1))
+        return rows[:page_size][::-1], len(rows) > page_size, True
+    rows = await fetchall(sql_after, (*params, key, page_size + 1))
+    return rows[:page_size], key > 0, len(rows) > page_size
+
+
+# Ученики
+async def get_student(user_id: int):
+    return await fetchone(SQL_STUDENT_BY_USER, (user_id,))
+
+
+async def get_student_by_id(student_id: int):
+    return await fetchone(SQL_STUDENT_BY_ID, (student_id,))
+
+
+async def get_student_class(user_id: int):
+    row = await fetchone(SQL_STUDENT_CLASS, (user_id,))
+    return row[0] if row else None
+
+
+# id нового ученика или None, если он уже был зарегистрирован
+async def add_student(user_id: int, first_name: str, last_name: str, class_name: str, username: str):
+    def insert(conn):
+        cursor = conn.execute(SQL_INSERT_STUDENT, (user_id, first_name, last_name, class_name, username))
+        if not cursor.rowcount:
+            return None
+        student_id = cursor.lastrowid
+        _bump_cache_version(conn, "students")
+        return student_id
+    return await write(insert, "add_student")
+
+
+# Строки для поиска: все или только добавленные после ученика after_id
+async def get_search_rows(after_id: int = 0):
+    return await fetchall(SQL_SEARCH_STUDENTS, (after_id,))
+
+
+async def get_class_roster(class_name: str, key: int = 0, backward: bool = False, page_size: int = 20):
+    return await fetch_page(SQL_CLASS_ROSTER_AFTER, SQL_CLASS_ROSTER_BEFORE, (class_name,), key, backward, page_size)
+
+
+async def get_class_latest_screenshots(class_name: str):
+    return await fetchall(SQL_CLASS_LATEST_SCREENSHOTS, (class_name,))
+
+
+# Классы и администраторы
+async def get_classes() -> list:
+    return list(_classes)
+
+
+async def add_class(name: str):
+    def insert(conn):
+        conn.execute(SQL_INSERT_CLASS, (name,))
+        return _bump_cache_version(conn, "classes")
+    version = await write(insert, "add_class")
+    _classes.append(name)
+    _applied("classes", version)
+
+
+async def save_admin(user_id: int, class_access: str):
+    def upsert(conn):
+        conn.execute(SQL_UPSERT_ADMIN, (user_id, class_access))
+        return _bump_cache_version(conn, "admins")
+    _applied("admins", await write(upsert, "save_admin"))
+
+
+async def get_admins():
+    return await fetchall(SQL_ADMINS)
+
+
+# Скриншоты
+async def get_student_screenshots(user_id: int, key: int = 0, backward: bool = False, page_size: int = 10):
+    return await fetch_page(SQL_STUDENT_SCREENSHOTS_AFTER, SQL_STUDENT_SCREENSHOTS_BEFORE, (user_id,),
+                            key, backward, page_size)
+
+
+# Класс ученика из первой строки выборки и строки без него; без строк класс — None
+def _split_class(rows: list) -> tuple:
+    return (rows[0][0] if rows else None), [row[1:] for row in rows]
+
+
+# Состав архивов: строки (id, путь, место в паке) в порядке добавления;
+# для ученика — вместе с его классом
+async def get_student_manifest(user_id: int) -> tuple:
+    return _split_class(await fetchall(SQL_STUDENT_MANIFEST, (user_id,)))
+
+
+async def get_class_manifest(class_name: str):
+    return await fetchall(SQL_CLASS_MANIFEST, (class_name,))
+
+
+async def get_all_manifest():
+    return await fetchall(SQL_ALL_MANIFEST)
+
+
+async def get_my_screenshots(user_id: int, key: int = 0, backward: bool = False, page_size: int = 20):
+    return await fetch_page(SQL_MY_SCREENSHOTS_AFTER, SQL_MY_SCREENSHOTS_BEFORE, (user_id,), key, backward, page_size)
+
+
+async def get_screenshot(sc_id: int):
+    return await fetchone(SQL_SCREENSHOT, (sc_id,))
+
+
+# (класс ученика, строки фото)
+async def get_student_photos(user_id: int) -> tuple:
+    return _split_class(await fetchall(SQL_STUDENT_PHOTOS, (user_id,)))
+
+
+def _insert_screenshot(conn: sqlite3.Connection, user_id: int, file_path: str, timestamp: str, file_id: str,
+                       file_unique_id: str, content_hash: str, phash: int) -> int:
+    uploaded_at = to_epoch(timestamp)
+    sc_id = conn.execute(SQL_INSERT_SCREENSHOT, (user_id, file_path, timestamp, file_id, file_unique_id,
+                                                 content_hash, phash, uploaded_at)).lastrowid
+    conn.execute(SQL_BUMP_STUDENT_STATS, (user_id, timestamp))
+    _bump_class_day(conn, user_id, timestamp, uploaded_at, sc_id)
+    return sc_id
+
+
+# Сводка класса за день: +1 загрузка и +1 ученик, если это его первая загрузка за эти сутки
+def _bump_class_day(conn: sqlite3.Connection, user_id: int, timestamp: str, uploaded_at: int, sc_id: int):
+    row = conn.execute(SQL_STUDENT_CLASS, (user_id,)).fetchone()
+    if uploaded_at is None or not row:
+        return
+    day = timestamp[:10]
+    start = day_start(day)
+    end = day_start((date.fromisoformat(day) + timedelta(days=1)).isoformat())
+    first_today = conn.execute(SQL_UPLOADED_SAME_DAY, (user_id, start, end, sc_id)).fetchone() is None
+    conn.execute(SQL_BUMP_CLASS_DAY, (row[0], day, int(first_today)))
+
+
+# Полный пересчёт сводки — после удаления скриншотов
+def rebuild_class_days(conn: sqlite3.Connection):
+    conn.execute(SQL_CLEAR_CLASS_DAYS)
+    conn.execute(SQL_REBUILD_CLASS_DAYS)
+
+
+async def add_screenshot(user_id: int, file_path: str, timestamp: str, file_id: str = None,
+                         file_unique_id: str = None, content_hash: str = None, phash: int = None) -> int:
+    return await write(lambda conn: _insert_screenshot(conn, user_id, file_path, timestamp, file_id,
+                                                       file_unique_id, content_hash, phash), "add_screenshot")
+
+
+async def set_screenshot_file_id(sc_id: int, file_id: str):
+    await execute(SQL_SET_SCREENSHOT_FILE_ID, (file_id, sc_id))
+
+
+# Дубли
+async def find_by_unique_id(file_unique_id: str, user_id: int):
+    return await fetchone(SQL_SCREENSHOT_BY_UNIQUE_ID, (file_unique_id, user_id))
+
+
+async def find_by_hash(content_hash: str, user_id: int):
+    return await fetchone(SQL_SCREENSHOT_BY_HASH, (content_hash, user_id))
+
+
+async def get_phashes():
+    return await fetchall(SQL_PHASHES)
+
+
+async def get_student_names() -> dict:
+    return {user_id: f"{fn} {ln}" for user_id, fn, ln in await fetchall(SQL_STUDENT_NAMES)}
+
+
+def refresh_student_stats(conn: sqlite3.Connection, user_id: int):
+    conn.execute(SQL_DELETE_STUDENT_STATS, (user_id,))
+    conn.execute(SQL_REFRESH_STUDENT_STATS, (user_id,))
+
+
+# Отчёт о сдаче по классу или по всей школе (class_name = None)
+async def stream_submission_report(class_name, consume):
+    return await stream(SQL_SUBMISSION_REPORT, (class_name,), consume)
+
+
+# Аналитика сдачи: since — день 'ГГГГ-ММ-ДД' по времени Алматы
+async def get_not_submitted(class_name, since: str) -> list:
+    return await fetchall(SQL_NOT_SUBMITTED, (class_name, day_start(since)))
+
+
+# [(класс, учеников, сдали, загрузок)] с начала дня since
+async def get_class_completion(since: str) -> list:
+    completion = await fetchall(SQL_CLASS_COMPLETION, (day_start(since),))
+    uploads = dict(await fetchall(SQL_CLASS_UPLOADS_SINCE, (since,)))
+    return [(class_name, total, submitted, uploads.get(class_name, 0)) for class_name, total, submitted in completion]
+
+
+# Обслуживание: пересчёт сводок и сжатие базы
+def _rebuild_rollups(conn: sqlite3.Connection):
+    rebuild_class_days(conn)
+    conn.execute(SQL_CLEAR_STUDENT_STATS)
+    conn.execute(SQL_REBUILD_STUDENT_STATS)
+
+
+async def rebuild_rollups():
+    await write(_rebuild_rollups, "rebuild_rollups")
+
+
+def _vacuum(conn: sqlite3.Connection):
+    conn.execute("VACUUM")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+async def vacuum():
+    await write_standalone(_vacuum, "vacuum")
+
+
+async def get_job_states() -> dict:
+    return {name: (last_run, next_run, error) for name, last_run, next_run, error in await fetchall(SQL_JOB_STATES)}
+
+
+async def save_job_state(name: str, last_run, next_run: int, error: str = None):
+    await execute(SQL_SAVE_JOB_STATE, (name, last_run, next_run, error))
+
+
+# Очередь загрузок
+async def add_pending_upload(user_id: int, chat_id: int, file_id: str, file_unique_id: str, file_path: str,
+                             timestamp: str):
+    def insert(conn):
+        cursor = conn.execute(SQL_INSERT_PENDING_UPLOAD, (user_id, chat_id, file_id, file_unique_id,
+                                                          file_path, timestamp))
+        # тот же файл от того же ученика уже ждёт скачивания
+        if not cursor.rowcount:
+            return None
+        return conn.execute(SQL_PENDING_UPLOAD, (cursor.lastrowid,)).fetchone()
+    return await write(insert, "add_pending_upload")
+
+
+async def get_pending_uploads() -> list:
+    return await fetchall(SQL_PENDING_UPLOADS)
+
+
+async def bump_upload_attempts(upload_id: int):
+    await execute(SQL_BUMP_UPLOAD_ATTEMPTS, (upload_id,))
+
+
+async def drop_pending_upload(upload_id: int):
+    await execute(SQL_DELETE_PENDING_UPLOAD, (upload_id,))
+
+
+# Пачка скачанных загрузок одной транзакцией: file_path = None — дубль, только убрать из очереди.
+# Хеш перепроверяется здесь, потому что дубль мог прийти в той же пачке
+def _complete_uploads(conn: sqlite3.Connection, uploads: list) -> int:
+    added = 0
+    for upload_id, user_id, file_path, timestamp, file_id, file_unique_id, content_hash, phash in uploads:
+        conn.execute(SQL_DELETE_PENDING_UPLOAD, (upload_id,))
+        if file_path is None:
+            continue
+        same = conn.execute(SQL_SCREENSHOT_BY_HASH, (content_hash, user_id)).fetchone() if content_hash else None
+        if same and same[1] == user_id:
+            continue
+        _insert_screenshot(conn, user_id, file_path, timestamp, file_id, file_unique_id, content_hash, phash)
+        added += 1
+    return added
+
+
+async def complete_uploads(uploads: list) -> int:
+    return await write(lambda conn: _complete_uploads(conn, uploads), "complete_uploads")
+
+
+# Рассылки: получатели фиксируются при создании, статус каждого хранится в базе
+def _create_broadcast(conn: sqlite3.Connection, text: str, class_name: str, admin_chat_id: int,
+                      status_message_id: int) -> int:
+    broadcast_id = conn.execute(SQL_INSERT_BROADCAST, (text, class_name, admin_chat_id, status_message_id)).lastrowid
+    if class_name:
+        conn.execute(SQL_ADD_RECIPIENTS_CLASS, (broadcast_id, class_name))
+    else:
+        conn.execute(SQL_ADD_RECIPIENTS_ALL, (broadcast_id,))
+    return broadcast_id
+
+
+async def create_broadcast(text: str, class_name: str, admin_chat_id: int, status_message_id: int) -> int:
+    return await write(lambda conn: _create_broadcast(conn, text, class_name, admin_chat_id, status_message_id),
+                       "create_broadcast")
+
+
+async def get_broadcast(broadcast_id: int):
+    return await fetchone(SQL_BROADCAST, (broadcast_id,))
+
+
+async def get_active_broadcasts() -> list:
+    return [row[0] for row in await fetchall(SQL_ACTIVE_BROADCASTS)]
+
+
+async def get_pending_recipients(broadcast_id: int) -> list:
+    return [row[0] for row in await fetchall(SQL_PENDING_RECIPIENTS, (broadcast_id,))]
+
+
+async def set_recipient_status(broadcast_id: int, user_id: int, status: str):
+    await execute(SQL_SET_RECIPIENT_STATUS, (status, broadcast_id, user_id))
+
+
+async def get_broadcast_counts(broadcast_id: int) -> dict:
+    return dict(await fetchall(SQL_BROADCAST_COUNTS, (broadcast_id,)))
+
+
+async def finish_broadcast(broadcast_id: int):
+    await execute(SQL_FINISH_BROADCAST, (broadcast_id,))
+
+
+# Настройки
+async def get_setting(key: str):
+    return _settings.get(key)
+
+
+async def set_setting(key: str, value):
+    def update(conn):
+        conn.execute(SQL_SET_SETTING, (value, key))
+        return _bump_cache_version(conn, "settings")
+    version = await write(update, "set_setting")
+    _settings[key] = value
+    _applied("settings", version)
+
+
+# Данные диалогов (user_data и состояния ConversationHandler) для persistence.DbPersistence
+async def get_user_data() -> list:
+    return await fetchall(SQL_USER_DATA)
+
+
+async def save_user_data(user_id: int, data: str):
+    await execute(SQL_SAVE_USER_DATA, (user_id, data))
+
+
+async def drop_user_data(user_id: int):
+    await execute(SQL_DROP_USER_DATA, (user_id,))
+
+
+async def get_conversations(name: str) -> list:
+    return await fetchall(SQL_CONVERSATIONS, (name,))
+
+
+async def save_conversation(name: str, key: str, state):
+    if state is None:
+        await execute(SQL_DROP_CONVERSATION, (name, key))
+    else:
+        await execute(SQL_SAVE_CONVERSATION, (name, key, state))
@@ -0,0 +1,130 @@
+import io
+import os
+import sys
+import hashlib
+import sqlite3
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import db
+import packs
+
+# Перцептивный хеш (dHash 8x8) и порог расстояния Хэмминга для «почти дублей»
+PHASH_SIZE = 8
+NEAR_DUPLICATE_DISTANCE = 6
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+# dHash: сравнение соседних пикселей уменьшенной серой копии.
+# Без Pillow перцептивный хеш не считается, остаётся только точное сравнение
+def perceptual_hash(data: bytes):
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            pixels = list(image.convert("L").resize((PHASH_SIZE + 1, PHASH_SIZE)).getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(PHASH_SIZE):
+        for col in range(PHASH_SIZE):
+            left = pixels[row * (PHASH_SIZE + 1) + col]
+            right = pixels[row * (PHASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    # SQLite хранит знаковые 64-битные целые
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def fingerprint(data: bytes) -> tuple:
+    return content_hash(data), perceptual_hash(data)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+# Пары похожих скриншотов внутри класса: rows = [(id, user_id, class, phash, timestamp)]
+def find_near_duplicates(rows: list, max_distance: int = NEAR_DUPLICATE_DISTANCE) -> list:
+    by_class = {}
+    for row in rows:
+        by_class.setdefault(row[2], []).append(row)
+    pairs = []
+    for class_rows in by_class.values():
+        for i, first in enumerate(class_rows):
+            for second in class_rows[i + 1:]:
+                distance = hamming(first[3], second[3])
+                if distance <= max_distance:
+                    pairs.append((distance, first, second))
+    pairs.sort(key=lambda pair: pair[0])
+    return pairs
+
+
+def write_photo(file_path: str, data: bytes):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+
+
+# Байты упакованного файла остаются в паке (он только дописывается), удаляется запись о нём
+def _remove_unreferenced(conn: sqlite3.Connection, file_path: str):
+    if conn.execute(db.SQL_SCREENSHOT_PATH_USED, (file_path,)).fetchone():
+        return
+    conn.execute(db.SQL_DELETE_PACK_ENTRY, (file_path,))
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+# Разовая очистка уже накопленных фото: хешируем строки без хеша,
+# повторы одного ученика удаляем, одинаковые файлы разных учеников
+# сводим к одному файлу на диске
+def backfill(path: str = None) -> dict:
+    conn = db.connect(path)
+    stats = {"hashed": 0, "removed": 0, "linked": 0, "missing": 0}
+    touched_users = set()
+    rows = conn.execute(db.SQL_UNHASHED_SCREENSHOTS).fetchall()
+    for sc_id, user_id, file_path, *where in rows:
+        data = packs.read(file_path, packs.location(*where))
+        if data is None:
+            stats["missing"] += 1
+            continue
+        sha, phash = fingerprint(data)
+        conn.execute("BEGIN IMMEDIATE")
+        existing = conn.execute(db.SQL_SCREENSHOT_BY_HASH, (sha, user_id)).fetchone()
+        if existing and existing[1] == user_id:
+            conn.execute(db.SQL_DELETE_SCREENSHOT, (sc_id,))
+            if existing[2] != file_path:
+                _remove_unreferenced(conn, file_path)
+            touched_users.add(user_id)
+            stats["removed"] += 1
+        elif existing:
+            conn.execute(db.SQL_LINK_SCREENSHOT, (existing[2], sha, phash, sc_id))
+            if existing[2] != file_path:
+                _remove_unreferenced(conn, file_path)
+            stats["linked"] += 1
+        else:
+            conn.execute(db.SQL_SET_SCREENSHOT_HASHES, (sha, phash, sc_id))
+        conn.execute("COMMIT")
+        stats["hashed"] += 1
+    conn.execute("BEGIN IMMEDIATE")
+    for user_id in touched_users:
+        db.refresh_student_stats(conn, user_id)
+    if stats["removed"]:
+        db.rebuild_class_days(conn)
+    conn.execute("COMMIT")
+    conn.close()
+    return stats
+
+
+if __name__ == '__main__':
+    db.init_db()
+    result = backfill(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"Проверено: {result['hashed']}, удалено повторов: {result['removed']}, "
+          f"связано с общим файлом: {result['linked']}, файлов не найдено: {result['missing']}")
@@ -0,0 +1,131 @@
+import io
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+AVAILABLE = Image is not None
+
+# Параметры обработки
+THUMBS_DIR = "thumbs"
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "0")) or max(1, (os.cpu_count() or 2) - 1)
+# Качество пережатия оригиналов (1–95)
+ORIGINAL_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+THUMB_SIZE = 320
+THUMB_QUALITY = 70
+
+# Обзорный лист: сетка миниатюр с подписями
+SHEET_COLUMNS = 5
+SHEET_TILE = 240
+SHEET_LABEL_HEIGHT = 36
+SHEET_MAX_TILES = 40
+FONT_PATHS = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+)
+
+_pool = None
+
+
+# Миниатюры лежат в THUMBS_DIR по тому же относительному пути, что и оригинал
+def thumbnail_path(file_path: str) -> str:
+    relative = os.path.splitdrive(os.path.normpath(file_path))[1].lstrip(os.sep)
+    return os.path.join(THUMBS_DIR, relative)
+
+
+# Выполняется в процессе пула: пережатие оригинала и миниатюра
+def _process_upload(file_path: str, quality: int):
+    with Image.open(file_path) as image:
+        image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality, optimize=True)
+        # Оригинал заменяем, только если пережатая копия меньше
+        if buffer.tell() < os.path.getsize(file_path):
+            tmp_path = file_path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(tmp_path, file_path)
+        image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        thumb = thumbnail_path(file_path)
+        os.makedirs(os.path.dirname(thumb), exist_ok=True)
+        image.save(thumb, "JPEG", quality=THUMB_QUALITY)
+
+
+def _load_font(size: int):
+    for path in FONT_PATHS:
+        if os.path.exists(path):
+            return ImageFont.truetype(path, size)
+    return ImageFont.load_default()
+
+
+def _fit_label(draw, text: str, font, width: int) -> str:
+    while text and draw.textlength(text, font=font) > width:
+        text = text[:-2] + "…" if len(text) > 1 else ""
+    return text
+
+
+# Выполняется в процессе пула: tiles = [(подпись, путь к фото или None, байты упакованного фото или None)]
+def _render_sheet(tiles: list) -> bytes:
+    rows = (len(tiles) + SHEET_COLUMNS - 1) // SHEET_COLUMNS
+    cell_height = SHEET_TILE + SHEET_LABEL_HEIGHT
+    sheet = Image.new("RGB", (SHEET_COLUMNS * SHEET_TILE, rows * cell_height), "white")
+    draw = ImageDraw.Draw(sheet)
+    font = _load_font(14)
+    for index, (label, path, data) in enumerate(tiles):
+        left = (index % SHEET_COLUMNS) * SHEET_TILE
+        top = (index // SHEET_COLUMNS) * cell_height
+        source = None
+        if data:
+            source = io.BytesIO(data)
+        elif path:
+            thumb = thumbnail_path(path)
+            source = thumb if os.path.exists(thumb) else path if os.path.exists(path) else None
+        if source:
+            with Image.open(source) as image:
+                image = image.convert("RGB")
+                image.thumbnail((SHEET_TILE - 8, SHEET_TILE - 8))
+                sheet.paste(image, (left + (SHEET_TILE - image.width) // 2, top + (SHEET_TILE - image.height) // 2))
+        else:
+            draw.rectangle((left + 4, top + 4, left + SHEET_TILE - 4, top + SHEET_TILE - 4), fill="#eeeeee")
+            draw.text((left + 12, top + SHEET_TILE // 2), "нет скриншота", fill="#888888", font=font)
+        draw.text((left + 6, top + SHEET_TILE + 8), _fit_label(draw, label, font, SHEET_TILE - 12),
+                  fill="black", font=font)
+    buffer = io.BytesIO()
+    sheet.save(buffer, "JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+# Фоновая обработка нового скриншота; обработчик обновления её не ждёт
+async def process_upload(file_path: str, quality: int = ORIGINAL_QUALITY):
+    if not AVAILABLE:
+        return
+    with metrics.timer(metrics.IO_SECONDS, op="image_process"):
+        await asyncio.get_running_loop().run_in_executor(_get_pool(), _process_upload, file_path, quality)
+
+
+# Обзорные листы класса, не больше SHEET_MAX_TILES учеников на листе
+async def contact_sheets(tiles: list) -> list:
+    loop = asyncio.get_running_loop()
+    chunks = [tiles[i:i + SHEET_MAX_TILES] for i in range(0, len(tiles), SHEET_MAX_TILES)]
+    return await asyncio.gather(*[loop.run_in_executor(_get_pool(), _render_sheet, chunk) for chunk in chunks])
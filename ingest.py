@@ -0,0 +1,168 @@
+import sys
+import asyncio
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+import db
+import cluster
+import dedupe
+import images
+import metrics
+
+# Ограниченный приём скриншотов: ученик получает ответ сразу, а файл
+# скачивает небольшой пул обработчиков. Очередь в памяти ограничена,
+# поэтому при всплеске загрузок обработчики сообщений ждут свободного места
+INGEST_WORKERS = 8
+QUEUE_SIZE = 256
+MAX_ATTEMPTS = 5
+BATCH_SIZE = 32
+FLUSH_INTERVAL = 0.5
+
+_queue = None
+_done = []
+_flush_now = None
+_tasks = []
+_images = set()
+
+
+async def _run_io(op: str, fn, *args):
+    with metrics.timer(metrics.IO_SECONDS, op=op):
+        return await asyncio.to_thread(fn, *args)
+
+
+def _image_done(task: asyncio.Task):
+    _images.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"⚠️ Скриншот не обработан: {task.exception()!r}", file=sys.stderr)
+
+
+# Обработка картинки — задача цикла, а не application.create_task: загрузка может
+# завершиться уже после Application.stop(), такие задачи дожидается stop()
+def _process_image(file_path: str):
+    task = asyncio.get_running_loop().create_task(images.process_upload(file_path))
+    _images.add(task)
+    task.add_done_callback(_image_done)
+
+
+# Скачивание и проверка на дубль; возвращает строку для complete_uploads
+async def _fetch(application, upload: tuple) -> tuple:
+    upload_id, user_id, _, file_id, file_unique_id, file_path, timestamp, _ = upload
+    photo_file = await application.bot.get_file(file_id)
+    data = bytes(await photo_file.download_as_bytearray())
+    sha, phash = await _run_io("hash_photo", dedupe.fingerprint, data)
+    same_content = await db.find_by_hash(sha, user_id)
+    if same_content and same_content[1] == user_id:
+        return upload_id, user_id, None, timestamp, file_id, file_unique_id, sha, phash
+    if same_content:
+        file_path = same_content[2]
+    else:
+        await _run_io("write_photo", dedupe.write_photo, file_path, data)
+        _process_image(file_path)
+    return upload_id, user_id, file_path, timestamp, file_id, file_unique_id, sha, phash
+
+
+# Одна загрузка с повторами; число попыток хранится в базе и переживает перезапуск.
+# RetryAfter — ожидание по требованию Telegram, а не неудачная попытка. Строка
+# удаляется только при BadRequest или исчерпании попыток; после непредвиденной
+# ошибки она остаётся в pending_uploads и будет подхвачена при следующем запуске
+async def _process(application, upload: tuple):
+    upload_id, chat_id, attempts = upload[0], upload[2], upload[7]
+    while attempts < MAX_ATTEMPTS:
+        try:
+            _done.append(await _fetch(application, upload))
+            if len(_done) >= BATCH_SIZE:
+                _flush_now.set()
+            return
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            await asyncio.sleep(retry_after)
+        except BadRequest:
+            break
+        except (TimedOut, NetworkError, OSError):
+            attempts += 1
+            await db.bump_upload_attempts(upload_id)
+            await asyncio.sleep(2 ** attempts)
+        except Exception as e:
+            print(f"⚠️ Загрузка {upload_id} отложена до перезапуска: {e!r}", file=sys.stderr)
+            await db.bump_upload_attempts(upload_id)
+            return
+    await db.drop_pending_upload(upload_id)
+    try:
+        await application.bot.send_message(chat_id, "⚠️ Не удалось сохранить скриншот. Пришлите его ещё раз.")
+    except (BadRequest, NetworkError):
+        pass
+
+
+async def _worker(application):
+    while True:
+        upload = await _queue.get()
+        try:
+            await _process(application, upload)
+        except Exception as e:
+            print(f"⚠️ Ошибка при обработке загрузки {upload[0]}: {e!r}", file=sys.stderr)
+        finally:
+            metrics.INGEST_QUEUE.dec()
+            _queue.task_done()
+
+
+# При ошибке записи пачка возвращается в начало _done и пишется на следующем такте
+async def _flush():
+    batch = _done[:]
+    del _done[:len(batch)]
+    if not batch:
+        return
+    try:
+        await db.complete_uploads(batch)
+    except BaseException:
+        _done[:0] = batch
+        raise
+
+
+# Готовые загрузки фиксируются пачкой: раз в FLUSH_INTERVAL или по BATCH_SIZE штук
+async def _flusher():
+    while True:
+        try:
+            await asyncio.wait_for(_flush_now.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_now.clear()
+        try:
+            await _flush()
+        except Exception as e:
+            print(f"⚠️ Не удалось записать загрузки, повтор через {FLUSH_INTERVAL} с: {e!r}", file=sys.stderr)
+
+
+async def submit(upload: tuple):
+    metrics.INGEST_QUEUE.inc()
+    await _queue.put(upload)
+
+
+async def _recover(uploads: list):
+    for upload in uploads:
+        await submit(upload)
+
+
+# Запуск пула при старте бота; незавершённые загрузки из базы снова ставятся в очередь.
+# Список читается до начала приёма обновлений (post_init), поэтому в него не попадают
+# загрузки, которые тут же поставит в очередь save_screenshot. В многопроцессном
+# режиме каждый процесс берёт только загрузки своих пользователей
+async def start(application):
+    global _queue, _flush_now
+    _queue = asyncio.Queue(QUEUE_SIZE)
+    _flush_now = asyncio.Event()
+    pending = [upload for upload in await db.get_pending_uploads() if cluster.owns(upload[1])]
+    loop = asyncio.get_running_loop()
+    _tasks.extend(loop.create_task(_worker(application)) for _ in range(INGEST_WORKERS))
+    _tasks.append(loop.create_task(_flusher()))
+    _tasks.append(loop.create_task(_recover(pending)))
+
+
+# Остановка до закрытия клиента Bot API (post_stop): готовые загрузки дописываются
+# в базу, прерванные остаются в pending_uploads до следующего запуска
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    await _flush()
+    await asyncio.gather(*_images, return_exceptions=True)
@@ -0,0 +1,56 @@
+import time
+import functools
+
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+import metrics
+
+
+def instrument_callback(callback, name: str):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        metrics.HANDLER_IN_FLIGHT.inc(handler=name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            metrics.HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+            metrics.HANDLER_IN_FLIGHT.dec(handler=name)
+    return wrapper
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for inner in nested:
+            _instrument_handler(inner)
+        return
+    callback = handler.callback
+    handler.callback = instrument_callback(callback, getattr(callback, "__name__", type(handler).__name__))
+
+
+# Оборачивает все зарегистрированные обработчики, включая вложенные в ConversationHandler
+def instrument_application(application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+# Время каждого запроса к Bot API по имени метода; скачивание файлов — отдельной серией
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = "file_download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.API_ERRORS.inc(method=endpoint)
+            raise
+        finally:
+            metrics.API_SECONDS.observe(time.perf_counter() - started, method=endpoint)
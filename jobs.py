@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import asyncio
+from datetime import datetime, time as day_time, timedelta
+
+import db
+import packs
+import metrics
+
+# Периодическое обслуживание на JobQueue. Время последнего и следующего запуска
+# каждой задачи хранится в scheduled_jobs: задачи, пропущенные, пока бот
+# был остановлен, выполняются сразу после старта
+TEMP_MAX_AGE = 3600
+TEMP_ZIP_MAX_BYTES = int(os.environ.get("TEMP_ZIP_MAX_MB", "2048")) * 1024 * 1024
+ARCHIVE_MAX_AGE = 7 * 86400
+NIGHTLY_AT = day_time(3, 0, tzinfo=db.TIMEZONE)
+
+_temp_dir = None
+_archive_cache = None
+
+
+def _temp_files() -> list:
+    files = []
+    for entry in os.scandir(_temp_dir):
+        if entry.is_file():
+            try:
+                files.append((entry.path, entry.stat()))
+            except FileNotFoundError:
+                pass
+    return files
+
+
+# Временные файлы вне кеша архивов (отчёты и т. п.), оставшиеся после сбоя
+def _clean_temp() -> int:
+    now = time.time()
+    removed = 0
+    for path, stat in _temp_files():
+        if now - stat.st_mtime > TEMP_MAX_AGE:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+# Кешу архивов достаётся всё место под TEMP_ZIP_DIR, не занятое другими временными файлами
+def _evict_archives() -> int:
+    other = sum(stat.st_size for _, stat in _temp_files())
+    return _archive_cache.evict(ARCHIVE_MAX_AGE, max(TEMP_ZIP_MAX_BYTES - other, 0))
+
+
+async def temp_cleanup():
+    await asyncio.to_thread(_clean_temp)
+
+
+async def archive_eviction():
+    await asyncio.to_thread(_evict_archives)
+
+
+async def pack_old_screenshots():
+    await asyncio.to_thread(packs.pack)
+
+
+# имя -> (функция, интервал в секундах или None для ночного запуска).
+# Ночные задачи выполняются по очереди в порядке словаря: VACUUM держит блокировку
+# базы, и запущенная рядом упаковка не дождалась бы записи. Сжатие базы — последним,
+# после перестройки сводок и упаковки
+JOBS = {
+    "temp_cleanup": (temp_cleanup, 15 * 60),
+    "archive_eviction": (archive_eviction, 30 * 60),
+    "rollup_maintenance": (db.rebuild_rollups, None),
+    "pack_old_screenshots": (pack_old_screenshots, None),
+    "db_maintenance": (db.vacuum, None),
+}
+NIGHTLY = [name for name, (_, interval) in JOBS.items() if interval is None]
+
+
+def _next_run(interval, now: float) -> int:
+    if interval:
+        return int(now + interval)
+    moment = datetime.fromtimestamp(now, db.TIMEZONE)
+    nightly = datetime.combine(moment.date(), NIGHTLY_AT)
+    if nightly <= moment:
+        nightly += timedelta(days=1)
+    return int(nightly.timestamp())
+
+
+async def _execute(name: str):
+    fn, interval = JOBS[name]
+    started = time.time()
+    error = None
+    try:
+        with metrics.timer(metrics.IO_SECONDS, op=f"job_{name}"):
+            await fn()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        print(f"⚠️ Задача {name} завершилась с ошибкой: {error}", file=sys.stderr)
+    await db.save_job_state(name, int(started), _next_run(interval, time.time()), error)
+
+
+async def _run(context):
+    await _execute(context.job.name)
+
+
+async def _run_nightly(context):
+    for name in context.job.data:
+        await _execute(name)
+
+
+# Планирование всех задач при старте бота
+async def start(application, temp_dir: str, archive_cache):
+    global _temp_dir, _archive_cache
+    _temp_dir, _archive_cache = temp_dir, archive_cache
+    job_queue = application.job_queue
+    if job_queue is None:
+        print("⚠️ JobQueue недоступна (нужен python-telegram-bot[job-queue]), обслуживание отключено",
+              file=sys.stderr)
+        return
+    states = await db.get_job_states()
+    now = time.time()
+    overdue = []
+    for name, (_, interval) in JOBS.items():
+        next_run = states[name][1] if name in states else None
+        if next_run is None:
+            # частые задачи при первом запуске выполняются сразу, ночные — в ближайшую ночь
+            next_run = int(now) if interval else _next_run(interval, now)
+            await db.save_job_state(name, None, next_run)
+        delay = max(next_run - now, 0)
+        # ночные задачи планируются одной цепочкой ниже
+        if not interval:
+            if delay == 0:
+                overdue.append(name)
+            continue
+        # пропущенный запуск выполняется сразу: APScheduler не запускает повторяющуюся задачу с first=0
+        if delay == 0:
+            job_queue.run_once(_run, 0, name=name)
+        job_queue.run_repeating(_run, interval, first=delay or interval, name=name)
+    if overdue:
+        job_queue.run_once(_run_nightly, 0, data=overdue, name="nightly")
+    job_queue.run_daily(_run_nightly, NIGHTLY_AT, data=NIGHTLY, name="nightly")
@@ -0,0 +1,181 @@
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек, в секундах
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value).replace(chr(34), chr(39))}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list:
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in self.values().items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # счётчики по корзинам, затем +Inf, сумма
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: list(series) for key, series in self._series.items()}
+
+    # Оценка квантиля по корзинам с линейной интерполяцией
+    def quantile(self, series: list, q: float) -> float:
+        total = sum(series[:-1])
+        if not total:
+            return 0.0
+        rank, seen, lower = q * total, 0, 0.0
+        for i, bound in enumerate(self.buckets):
+            count = series[i]
+            if seen + count >= rank:
+                return lower + (bound - lower) * ((rank - seen) / count if count else 0)
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = []
+        for key, series in self.snapshot().items():
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += series[i]
+                lines.append(f"{self.name}_bucket{_format_labels(key, (('le', bound),))} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(key, (('le', '+Inf'),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время выполнения обработчика")
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках")
+HANDLER_IN_FLIGHT = Gauge("bot_handler_in_flight", "Обработчики, выполняющиеся сейчас")
+DB_SECONDS = Histogram("bot_db_query_seconds", "Время запроса к SQLite, включая ожидание очереди")
+IO_SECONDS = Histogram("bot_io_seconds", "Время файловых операций и сборки архивов")
+API_SECONDS = Histogram("bot_telegram_api_seconds", "Время запроса к Bot API")
+API_ERRORS = Counter("bot_telegram_api_errors_total", "Ошибки запросов к Bot API")
+INGEST_QUEUE = Gauge("bot_ingest_queue", "Скриншоты, ожидающие скачивания")
+LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "Опоздание пробуждения цикла событий")
+
+
+@contextmanager
+def timer(histogram: Histogram, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+# Задержка цикла событий: насколько позже заказанного просыпается sleep.
+# Всё, что блокирует цикл (синхронный код в обработчиках), видно здесь
+async def monitor_loop_lag(interval: float = 0.1):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Сводка для команды /stats: самые медленные серии гистограммы по p99
+def summary(histogram: Histogram, label: str, limit: int = 10) -> list:
+    rows = []
+    for key, series in histogram.snapshot().items():
+        count = sum(series[:-1])
+        if count:
+            rows.append((dict(key).get(label, "?"), count, series[-1] / count,
+                         histogram.quantile(series, 0.5), histogram.quantile(series, 0.99)))
+    rows.sort(key=lambda row: row[4], reverse=True)
+    return rows[:limit]
+
+
+# Локальная точка для Prometheus: GET /metrics
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body, status = render().encode(), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> asyncio.AbstractServer:
+    return await asyncio.start_server(_handle_http, host, port)
@@ -0,0 +1,120 @@
+import os
+import re
+import sys
+import mmap
+import time
+import itertools
+import threading
+
+import db
+import images
+
+# Хранение по уровням: свежие скриншоты лежат отдельными файлами, а старше
+# PACK_AFTER_DAYS дней переносятся в пак-файлы по классу и месяцу
+# (packs/<класс>/<ГГГГ-ММ>.pack). Место каждого файла внутри пака хранится
+# в pack_entries, чтение идёт через mmap без распаковки
+PACKS_DIR = "packs"
+PACK_AFTER_DAYS = int(os.environ.get("PACK_AFTER_DAYS", "60"))
+
+_maps = {}
+_maps_lock = threading.Lock()
+
+
+# (pack_path, offset, size) из строки запроса или None, если файл не упакован
+def location(pack_path, offset, size):
+    if pack_path is None:
+        return None
+    return pack_path, offset, size
+
+
+def pack_path(class_name: str, month: str) -> str:
+    return os.path.join(PACKS_DIR, re.sub(r"[^\w-]", "_", class_name or "_"), f"{month}.pack")
+
+
+# Пак только дописывается: если запись оказалась за концом отображения, файл отображается заново
+def _map(path: str, end: int) -> mmap.mmap:
+    with _maps_lock:
+        mapped = _maps.get(path)
+        if mapped is None or len(mapped) < end:
+            with open(path, "rb") as f:
+                mapped = _maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped
+
+
+# Байты скриншота: из пака, если он упакован, иначе из отдельного файла; None — файла нет
+def read(file_path: str, where: tuple = None):
+    if where:
+        path, offset, size = where
+        try:
+            return _map(path, offset + size)[offset:offset + size]
+        except (OSError, ValueError):
+            return None
+    try:
+        with open(file_path, "rb") as f:
+            return f.read()
+    except (OSError, TypeError):
+        return None
+
+
+def size(file_path: str, where: tuple = None) -> int:
+    return where[2] if where else os.path.getsize(file_path)
+
+
+def close():
+    with _maps_lock:
+        for mapped in _maps.values():
+            mapped.close()
+        _maps.clear()
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Упаковка файлов старше older_than_days. Порядок защищает от потерь при сбое:
+# байты дописываются в пак и сбрасываются на диск, затем индекс фиксируется
+# в базе, и только после этого удаляются отдельные файлы и их миниатюры
+def pack(path: str = None, older_than_days: int = PACK_AFTER_DAYS) -> dict:
+    conn = db.connect(path)
+    stats = {"packed": 0, "missing": 0, "bytes": 0, "packs": 0}
+    cutoff = int(time.time()) - older_than_days * 86400
+    rows = conn.execute(db.SQL_PACK_CANDIDATES, (cutoff,)).fetchall()
+    for (class_name, month), group in itertools.groupby(rows, key=lambda row: (row[1], row[2])):
+        target = pack_path(class_name, month)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        entries = []
+        with open(target, "ab") as f:
+            for file_path, _, _ in group:
+                try:
+                    with open(file_path, "rb") as source:
+                        data = source.read()
+                except OSError:
+                    stats["missing"] += 1
+                    continue
+                entries.append((file_path, target, f.tell(), len(data)))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if not entries:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(db.SQL_INSERT_PACK_ENTRY, entries)
+        conn.execute("COMMIT")
+        for file_path, _, _, length in entries:
+            _remove(file_path)
+            _remove(images.thumbnail_path(file_path))
+            stats["bytes"] += length
+        stats["packed"] += len(entries)
+        stats["packs"] += 1
+    conn.close()
+    return stats
+
+
+if __name__ == '__main__':
+    db.init_db()
+    result = pack(older_than_days=int(sys.argv[1]) if len(sys.argv) > 1 else PACK_AFTER_DAYS)
+    print(f"Упаковано файлов: {result['packed']} ({result['bytes'] // 1024} КБ) в {result['packs']} пак(ов), "
+          f"файлов не найдено: {result['missing']}")
@@ -0,0 +1,65 @@
+import json
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import db
+
+# Хранение user_data и состояний ConversationHandler в общей базе: диалоги
+# переживают перезапуск и доступны любому процессу бота. bot_data не сохраняется —
+# там живут задачи и серверы текущего процесса. Значения пишутся в JSON
+PERSISTENCE_INTERVAL = 5
+
+
+class DbPersistence(BasePersistence):
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval)
+
+    async def get_user_data(self) -> dict:
+        return {user_id: json.loads(data) for user_id, data in await db.get_user_data()}
+
+    async def update_user_data(self, user_id: int, data: dict):
+        await db.save_user_data(user_id, json.dumps(data, ensure_ascii=False))
+
+    async def drop_user_data(self, user_id: int):
+        await db.drop_user_data(user_id)
+
+    # Ключ диалога — кортеж id (чат, пользователь), в базе — JSON-список
+    async def get_conversations(self, name: str) -> dict:
+        return {tuple(json.loads(key)): json.loads(state) for key, state in await db.get_conversations(name)}
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        await db.save_conversation(name, json.dumps(key), None if new_state is None else json.dumps(new_state))
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def flush(self):
+        pass
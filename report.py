@@ -0,0 +1,51 @@
+import csv
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+import db
+import metrics
+
+# Отчёт о сдаче скриншотов: строки пишутся в файл по мере чтения курсора
+# в потоке чтения базы, так что память не растёт с размером школы
+HEADER = ("Класс", "Фамилия", "Имя", "Username", "Скриншотов", "Первый", "Последний")
+XLSX_AVAILABLE = Workbook is not None
+
+
+def _row(row) -> tuple:
+    class_name, last_name, first_name, username, count, first, last = row
+    return class_name, last_name, first_name, f"@{username}" if username else "", count, first or "", last or ""
+
+
+# Разделитель «;» и BOM: так файл сразу открывается в Excel с русской локалью
+def _write_csv(path: str, cursor) -> int:
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(HEADER)
+        for row in cursor:
+            writer.writerow(_row(row))
+            count += 1
+    return count
+
+
+# Книга в режиме write_only: openpyxl сбрасывает строки на диск, а не держит их в памяти
+def _write_xlsx(path: str, cursor) -> int:
+    count = 0
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Отчёт")
+    sheet.append(HEADER)
+    for row in cursor:
+        sheet.append(_row(row))
+        count += 1
+    workbook.save(path)
+    return count
+
+
+# Возвращает число учеников в отчёте
+async def build(path: str, class_name: str = None, fmt: str = "csv") -> int:
+    writer = _write_xlsx if fmt == "xlsx" else _write_csv
+    with metrics.timer(metrics.IO_SECONDS, op=f"report_{fmt}"):
+        return await db.stream_submission_report(class_name, lambda cursor: writer(path, cursor))
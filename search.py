@@ -0,0 +1,97 @@
+import db
+
+# Нечёткий поиск учеников по имени, фамилии и username: триграммный индекс в памяти.
+# Кириллица переводится в латиницу, поэтому «Иванов», «ivanov» и «Иваnов» находят
+# одного и того же ученика, а опечатка в одной-двух буквах оставляет большинство триграмм
+TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+    "у": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "", "ы": "y", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya",
+    # казахские буквы
+    "ә": "a", "ғ": "g", "қ": "k", "ң": "n", "ө": "o", "ұ": "u", "ү": "u", "һ": "h", "і": "i",
+}
+# Латинские варианты написания, которые дают те же звуки
+LATIN = (("kh", "h"), ("w", "v"), ("x", "ks"), ("j", "zh"), ("q", "k"), ("iy", "i"), ("yy", "i"))
+MIN_SCORE = 0.45
+MAX_RESULTS = 20
+
+# id ученика -> (имя, фамилия, класс) и триграмма -> множество id
+_students = {}
+_words = {}
+_index = {}
+# Наибольший id, загруженный из базы: ученики только добавляются, поэтому
+# изменения из других процессов бота догружаются по id
+_loaded_id = 0
+
+
+def normalize(text: str) -> str:
+    text = "".join(TRANSLIT.get(char, char) for char in (text or "").lower())
+    for latin, same in LATIN:
+        text = text.replace(latin, same)
+    return "".join(char if char.isalnum() else " " for char in text)
+
+
+def trigrams(word: str) -> frozenset:
+    padded = f"  {word} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def add(student_id: int, first_name: str, last_name: str, username: str, class_name: str):
+    _students[student_id] = (first_name, last_name, class_name)
+    words = [trigrams(word) for word in normalize(f"{first_name} {last_name} {username or ''}").split()]
+    _words[student_id] = words
+    for grams in words:
+        for gram in grams:
+            _index.setdefault(gram, set()).add(student_id)
+
+
+def load(rows, clear: bool = True):
+    global _loaded_id
+    if clear:
+        _students.clear()
+        _words.clear()
+        _index.clear()
+        _loaded_id = 0
+    for row in rows:
+        add(*row)
+        _loaded_id = max(_loaded_id, row[0])
+
+
+async def refresh():
+    load(await db.get_search_rows())
+
+
+# Догрузка учеников, добавленных после последней загрузки (в том числе другими процессами)
+async def update():
+    load(await db.get_search_rows(_loaded_id), clear=False)
+
+
+# Сходство слова запроса со словом ученика: коэффициент Дайса по триграммам
+def _similarity(query: frozenset, word: frozenset) -> float:
+    return 2 * len(query & word) / (len(query) + len(word))
+
+
+# Ученики, похожие на запрос, по убыванию сходства: [(id, имя, фамилия, класс)].
+# Каждое слово запроса сравнивается с лучшим подходящим словом ученика;
+# accept(класс) отсекает учеников из недоступных классов
+def find(query: str, limit: int = MAX_RESULTS, accept=None) -> list:
+    terms = [trigrams(word) for word in normalize(query).split()]
+    if not terms:
+        return []
+    candidates = set()
+    for grams in terms:
+        for gram in grams:
+            candidates.update(_index.get(gram, ()))
+    scored = []
+    for student_id in candidates:
+        if accept and not accept(_students[student_id][2]):
+            continue
+        words = _words[student_id]
+        if not words:
+            continue
+        score = sum(max(_similarity(grams, word) for word in words) for grams in terms) / len(terms)
+        if score >= MIN_SCORE:
+            scored.append((score, student_id))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [(student_id, *_students[student_id]) for _, student_id in scored[:limit]]
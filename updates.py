@@ -0,0 +1,54 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+# Пользователь (или чат), к которому относится обновление; None — ни того, ни другого
+def update_key(update: object):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+# Параллельная обработка обновлений с ограничением общего числа и
+# строгим порядком в пределах одного пользователя: шаги регистрации и
+# загрузки скриншота не обгоняют друг друга в ConversationHandler.
+# Обновление сначала встаёт в очередь своего пользователя (asyncio.Lock
+# пропускает ожидающих по порядку) и только потом занимает общий слот,
+# поэтому очередь одного пользователя не отнимает слоты у остальных
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+
+    async def process_update(self, update: object, coroutine):
+        key = update_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        # Для каждого пользователя: замок и число обновлений, которые его держат или ждут
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
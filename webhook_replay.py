@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Локальная замена Telegram для режима webhook: отправляет обновления
+# (по одному JSON на строку) POST-запросами на встроенный сервер бота.
+# Запуск: python webhook_replay.py updates.jsonl [параллельность]
+WEBHOOK_URL = os.environ.get("REPLAY_URL", "http://127.0.0.1:8443/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
+
+def post_update(body: bytes) -> float:
+    headers = {"Content-Type": "application/json"}
+    if WEBHOOK_SECRET:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET
+    request = urllib.request.Request(WEBHOOK_URL, data=body, headers=headers, method="POST")
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def main():
+    path = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    with open(path, encoding="utf-8") as f:
+        updates = [json.dumps(json.loads(line)).encode() for line in f if line.strip()]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(post_update, updates))
+    elapsed = time.perf_counter() - started
+    if latencies:
+        print(f"Отправлено: {len(latencies)} за {elapsed:.2f} с ({len(latencies) / elapsed:.1f}/с), "
+              f"p50: {latencies[len(latencies) // 2] * 1000:.1f} мс, "
+              f"p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f} мс")
+
+
+if __name__ == '__main__':
+    main()